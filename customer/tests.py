@@ -1,3 +1,171 @@
+from unittest import mock
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from main import badges, cart
+from main.cache import get_catalog_version
+from main.models import CartItem, OrderDetails, Orders, OutboxEmail, Payment, Product, Review
+from main.product_page import REVIEWS_PER_PAGE
+from main.testing import create_address, create_customer, create_product
 
-# Create your tests here.
+
+class ProductDetailsQueriesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = create_product('acme-phone')
+        for index in range(3):
+            create_product('acme-phone-{}'.format(index))
+        self.customer = create_customer('shopper')
+        self.client.force_login(self.customer.user)
+        self.url = '/customer/product/details/{}/'.format(self.product.slug)
+
+    def add_reviews(self, count):
+        for index in range(count):
+            reviewer = create_customer('reviewer{}'.format(Review.objects.count()))
+            Review.objects.create(customer=reviewer, product=self.product, name=reviewer.user.first_name,
+                                  rate=index % 5 + 1, message_review='Review {}'.format(index))
+
+    def load_page(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def count_queries(self):
+        # The first load warms the navigation, badge, leaderboard and rating histogram caches
+        self.load_page()
+        with CaptureQueriesContext(connection) as queries:
+            self.load_page()
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_reviews(self):
+        self.add_reviews(1)
+        expected = self.count_queries()
+
+        self.add_reviews(30)
+        self.load_page()
+        with self.assertNumQueries(expected):
+            response = self.load_page()
+        self.assertEqual(len(response.context['reviews']), REVIEWS_PER_PAGE)
+
+
+class ReviewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = create_product('acme-phone')
+        self.customer = create_customer('shopper')
+        self.client.force_login(self.customer.user)
+
+    def test_reviews_update_the_rating_without_invalidating_the_catalog(self):
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/customer/product/add_review/acme-phone/',
+                             {'name': 'Shopper', 'rating': 4, 'message': 'Good'})
+        product = Product.objects.get(id=self.product.id)
+        self.assertEqual((product.review_rate_average, product.review_count), (4, 1))
+        review = Review.objects.get(product=product)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/customer/product/delete_review/{}/'.format(review.id))
+        self.assertEqual(Product.objects.get(id=self.product.id).review_count, 0)
+        self.assertEqual(get_catalog_version(), version)
+
+
+class CartApiTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = create_product('acme-phone', stock=3)
+        self.customer = create_customer('shopper')
+        self.client.force_login(self.customer.user)
+        cart.add_item(self.customer, self.product.slug)
+
+    def post(self, action, data=None, slug='acme-phone'):
+        return self.client.post('/customer/cart/api/{}/{}/'.format(action, slug), data or {})
+
+    def test_changes_return_the_line_and_totals(self):
+        response = self.post('add_quantity')
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result['status'], cart.UPDATED)
+        self.assertEqual((result['line']['slug'], result['line']['quantity']), ('acme-phone', 2))
+        self.assertEqual((result['totals']['quantity'], result['totals']['count']), (2, 1))
+
+        result = self.post('update_quantity', {'quantity': 3}).json()
+        self.assertEqual((result['line']['quantity'], float(result['totals']['total'])), (3, 300))
+        result = self.post('remove_quantity').json()
+        self.assertEqual(result['line']['quantity'], 2)
+
+    def test_removing_the_line_updates_the_badge(self):
+        result = self.post('remove_from_cart').json()
+        self.assertEqual((result['status'], result['line'], result['totals']['count']), (cart.REMOVED, None, 0))
+        self.assertEqual(badges.get_badges(self.customer.user_id)[badges.CART], 0)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_refused_changes_have_error_statuses(self):
+        self.assertEqual(self.post('update_quantity', {'quantity': 4}).status_code, 409)
+        self.assertEqual(self.post('add_quantity', slug='missing').status_code, 404)
+        self.assertEqual(self.post('update_quantity', {'quantity': 'many'}).status_code, 400)
+        self.assertEqual(self.post('update_quantity', {'quantity': -1}).status_code, 400)
+        self.assertEqual(self.client.get('/customer/cart/api/add_quantity/acme-phone/').status_code, 405)
+        self.assertEqual(CartItem.objects.get(customer=self.customer).quantity, 1)
+
+
+class CheckoutTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = create_product('acme-phone', stock=5)
+        self.customer = create_customer('shopper')
+        self.address = create_address(self.customer)
+        self.client.force_login(self.customer.user)
+        cart.add_item(self.customer, self.product.slug, 2)
+
+    def checkout_token(self):
+        response = self.client.get('/customer/checkout/')
+        self.assertEqual(response.status_code, 200)
+        return response.context['checkout_token']
+
+    def submit(self, checkout_token):
+        return self.client.post('/customer/checkout/', {'delivery_address': self.address.id,
+                                                        'payment_method': 'Cash on Delivery',
+                                                        'checkout_token': checkout_token})
+
+    def test_order_is_placed_without_an_admin_account(self):
+        response = self.submit(self.checkout_token())
+        self.assertEqual(response.status_code, 200)
+        order = Orders.objects.get(customer=self.customer)
+        self.assertEqual(response.context['order'], order)
+        self.assertFalse(CartItem.objects.filter(customer=self.customer).exists())
+        # Only the customer emails are queued
+        self.assertEqual(sorted(email.to[0] for email in OutboxEmail.objects.all()),
+                         ['delivery@example.com', 'shopper@example.com'])
+
+    def test_replayed_checkout_token_returns_the_same_order(self):
+        checkout_token = self.checkout_token()
+        order = self.submit(checkout_token).context['order']
+        emails = OutboxEmail.objects.count()
+
+        # A double click or a retry of the same form, even after the cart was filled again
+        cart.add_item(self.customer, self.product.slug)
+        response = self.submit(checkout_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['order'], order)
+        self.assertEqual(Orders.objects.count(), 1)
+        self.assertEqual(OrderDetails.objects.count(), 1)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(OutboxEmail.objects.count(), emails)
+        self.assertEqual(Product.objects.get(id=self.product.id).stock, 3)
+        self.assertEqual(CartItem.objects.get(customer=self.customer).quantity, 1)
+
+    def test_other_integrity_errors_are_not_taken_for_a_replay(self):
+        Payment.objects.create(customer=self.customer, payment_method='Cash on Delivery', payment_status='Paid',
+                               total=10, transaction_id='0000000000000000001')
+        checkout_token = self.checkout_token()
+        with mock.patch('main.checkout.new_transaction_id', return_value='0000000000000000001'):
+            response = self.submit(checkout_token)
+        self.assertRedirects(response, '/customer/checkout/', fetch_redirect_response=False)
+        # The checkout page comes back with a new token for the retry
+        response = self.client.get('/customer/checkout/')
+        self.assertContains(response, 'Your order could not be placed')
+        self.assertNotEqual(response.context['checkout_token'], checkout_token)
+        self.assertFalse(Orders.objects.exists())
+        self.assertEqual(Product.objects.get(id=self.product.id).stock, 5)
+        self.assertEqual(CartItem.objects.get(customer=self.customer).quantity, 2)
@@ -7,6 +7,7 @@ urlpatterns = [
     path('about/', views.about, name='about'),
     path('product/details/<str:slug>/', views.product_details, name='product_details'),
     path('product/search/', views.product_search, name='search'),
+    path('product/autocomplete/', views.product_autocomplete, name='product_autocomplete'),
     path('product/category/<str:slug>/', views.product_list_category, name='product_list_category'),
     path('product/brand/<str:slug>/', views.product_list_brand, name='product_list_brand'),
     path('product/add_review/<str:slug>/', views.add_review, name='add_review'),
@@ -28,6 +29,10 @@ urlpatterns = [
     path('remove_quantity/<str:slug>/', views.remove_quantity, name='remove_quantity'),
     path('checkout/', views.checkout, name='checkout'),
     path('update_quantity/<str:slug>/', views.update_quantity, name='update_cart'),
+    path('cart/api/add_quantity/<str:slug>/', views.add_quantity_json, name='add_quantity_json'),
+    path('cart/api/remove_quantity/<str:slug>/', views.remove_quantity_json, name='remove_quantity_json'),
+    path('cart/api/update_quantity/<str:slug>/', views.update_quantity_json, name='update_quantity_json'),
+    path('cart/api/remove_from_cart/<str:slug>/', views.remove_from_cart_json, name='remove_from_cart_json'),
     path('apply_coupon/', views.apply_coupon, name='apply_coupon'),
     path('remove_coupon/', views.remove_coupon, name='remove_coupon'),
     path('track_orders/', views.track_orders, name='track_orders'),
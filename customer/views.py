@@ -1,9 +1,11 @@
-from datetime import datetime
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import EmailMessage
 from django.core.paginator import Paginator
-from django.db.models import Avg
+from main.pagination import KeysetPaginator
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, Sum
+from django.db.models.functions import Coalesce
 from django.http import JsonResponse
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
@@ -12,7 +14,16 @@ from django.contrib import messages
 from django.template.loader import render_to_string
 from django.utils import timezone
 from .forms import FeedbackForm
-from main.models import Customer, Category, Brand, Product, Coupon, Feedback, CartItem, DeliveryAddress, Orders, \
+from main.search import search_products
+from main.facets import normalize_filters, filter_q, get_facets
+from main.counters import record_view
+from main.leaderboards import get_leaderboard
+from main.product_page import load_product_details
+from main.autocomplete import suggest
+from main.checkout import place_order, placed_order, clean_checkout_token, new_checkout_token, OutOfStock
+from main import badges, cart, coupons, inventory, outbox
+from main.page_cache import cache_anonymous_page, product_tag, LISTING_TAG, NAVIGATION_TAG
+from main.models import Category, Brand, Product, Feedback, CartItem, DeliveryAddress, Orders, \
     OrderDetails, Wishlist, Payment, Review
 from django.contrib.auth.models import User
 import io
@@ -50,7 +61,7 @@ def send_email(request, email):
     form_email = 'LCL Shop <lclshop.dev@gmail.com>'
     email = EmailMessage(mail_subject, message, form_email, to_email)
     email.content_subtype = "html"
-    email.send()
+    outbox.queue(email)
 
 
 def send_feedback(request):
@@ -70,9 +81,12 @@ def about(request):
 
 
 # Code pagination
-def paginator(request, objects):
+def paginator(request, objects, ordering=None, with_count=True):
     # Set the number of items per page
     per_page = 8
+    # Keyset mode: seek on (ordering, id) from the opaque cursor in the request's GET parameters
+    if ordering:
+        return KeysetPaginator(objects, per_page, ordering, with_count).get_page(request.GET.get('cursor'))
     # Create a Paginator object with the customers queryset and the per_page value
     page = Paginator(objects, per_page)
 
@@ -84,38 +98,43 @@ def paginator(request, objects):
     return page_obj
 
 
+# Anonymous product pages are served from the page cache, their views are still counted
+def count_cached_view(request, meta):
+    record_view(meta['product_id'])
+
+
 # Code for display product
+@cache_anonymous_page(lambda request, slug: [LISTING_TAG, NAVIGATION_TAG, product_tag(slug)],
+                      on_hit=count_cached_view)
 def product_details(request, slug):
-    product = Product.objects.get(slug=slug)
-    reviews = Review.objects.filter(product=product, review_status=True).order_by('-date_added')
-    get_review_count_for_product = Review.objects.filter(product=product).count()
-    related_products = Product.objects.filter(category=product.category).exclude(id=product.id)[:4]
-    recommended_products = Product.objects.all().order_by('-view_count')[:4]
+    context = load_product_details(slug, request.GET.get('cursor'))
+    product = context['product']
 
-    # Update view count
-    product.view_count += 1
-    product.save()
+    # Update view count, buffered and flushed to the database periodically
+    product.view_count += record_view(product.id)
+    request.page_cache_meta = {'product_id': product.id}
 
-    discount_price = product.old_price - product.price
     if request.user.is_authenticated:
-        customer = Customer.objects.get(user=request.user)
-        reviews_customer = Review.objects.filter(product=product, customer=customer, review_status=True)
+        customer = request.user.customer
+        reviews_customer = list(Review.objects.filter(product=product, customer=customer, review_status=True)
+                                .select_related('customer'))
     else:
         customer = None
         reviews_customer = None
-    context = {
-        'discount_price': discount_price,
+    context.update({
+        'discount_price': product.old_price - product.price,
         'customer': customer,
         'reviews_customer': reviews_customer,
-        'reviews': reviews,
-        'product': product,
-        'get_review_count_for_product': get_review_count_for_product,
-        'related_products': related_products,
-        'recommended_products': recommended_products,
-    }
+        'recommended_products': get_leaderboard('view_count'),
+    })
     return render(request, 'customer_help/customer_product_details.html', context)
 
 
+# Suggestions for the storefront search box, served from the in-memory autocomplete index
+def product_autocomplete(request):
+    return JsonResponse({'results': suggest(request.GET.get('q', ''))})
+
+
 # Search product and filter product
 def product_search(request):
     if request.method == 'POST':
@@ -126,25 +145,13 @@ def product_search(request):
         filter_by_category = request.POST.get('filter_by_category')
         products = Product.objects.all().order_by('-sold')
         sort_price = request.POST.get('sort_price')
+        filters = normalize_filters(search_query, filter_by_brand, filter_by_category, sort_price)
 
-        # apply brand filter if selected
-        if filter_by_brand and filter_by_category:
-            products = products.filter(brand__id=filter_by_brand, category__id=filter_by_category)
-
-        elif filter_by_brand:
-            products = products.filter(brand__id=filter_by_brand)
-
-        # apply category filter if selected
-        elif filter_by_category:
-            products = products.filter(category__id=filter_by_category)
-
-        # apply search filter if search query exists
+        # apply full text search if search query exists, most relevant products first
         if search_query:
-            products = products.filter(
-                Q(name__icontains=search_query) | Q(
-                    category__name__icontains=search_query) | Q(
-                    brand__name__icontains=search_query) | Q(slug__icontains=search_query)
-            )
+            products = search_products(products, search_query).order_by('-search_rank', '-sold')
+        # apply brand, category and price filters
+        products = products.filter(filter_q(filters))
         # apply sorting based on selected option
         if sort_by == 'newest':
             products = products.order_by('-created_date')
@@ -161,36 +168,30 @@ def product_search(request):
         elif sort_by == 'price_desc':
             products = products.order_by('-price')
 
-        if sort_price == 'less_100':
-            products = products.filter(price__lte=100)
-        elif sort_price == '100_500':
-            products = products.filter(price__gte=100, price__lte=500)
-        elif sort_price == '500_1000':
-            products = products.filter(price__gte=500, price__lte=1000)
-        elif sort_price == '1000_2000':
-            products = products.filter(price__gte=1000, price__lte=2000)
-        elif sort_price == 'greater_2000':
-            products = products.filter(price__gte=2000)
-
-        if filter_by_brand:
-            filter_by_brand = int(filter_by_brand)
-        if filter_by_category:
-            filter_by_category = int(filter_by_category)
         page_obj = paginator(request, products)
+        # count how many products each brand, category and price range would return
+        facets = get_facets(filters)
         context = {
             'products': page_obj,
             'search_query': search_query,
             'sort_by': sort_by,
-            'filter_by_brand': filter_by_brand,
-            'filter_by_category': filter_by_category,
+            'filter_by_brand': filters['brand'],
+            'filter_by_category': filters['category'],
             'sort_price': sort_price,
+            'brand_facets': facets['brands'],
+            'category_facets': facets['categories'],
+            'price_facets': facets['prices'],
         }
         return render(request, 'customer_help/customer_product_list.html', context)
     else:
         products = Product.objects.all()
         page_object = paginator(request, products)
+        facets = get_facets(normalize_filters())
         context = {
             'products': page_object,
+            'brand_facets': facets['brands'],
+            'category_facets': facets['categories'],
+            'price_facets': facets['prices'],
         }
         return render(request, 'customer_help/customer_product_list.html', context)
 
@@ -253,7 +254,7 @@ def add_review(request, slug):
             product.review_rate_average = review_rate_average.get('rate__avg', 0) or 0
             # Update product review count
             product.review_count = Review.objects.filter(product=product).count()
-            product.save()
+            product.save(update_fields=['review_rate_average', 'review_count'])
             messages.success(request, 'Review updated successfully. Thanks for your review to improve our service.')
             return redirect('/customer/product/details/{}/'.format(slug))
         except Review.DoesNotExist:
@@ -265,7 +266,7 @@ def add_review(request, slug):
             product.review_rate_average = review_rate_average.get('rate__avg', 0) or 0
             # Update product review count
             product.review_count = Review.objects.filter(product=product).count()
-            product.save()
+            product.save(update_fields=['review_rate_average', 'review_count'])
             messages.success(request, 'Review updated successfully. Thanks for your review to improve our service.')
             return redirect('/customer/product/details/{}/'.format(slug))
     else:
@@ -286,7 +287,7 @@ def edit_review(request, review_id):
         product.review_rate_average = review_rate_average.get('rate__avg', 0) or 0
         # Update product review count
         product.review_count = Review.objects.filter(product=product).count()
-        product.save()
+        product.save(update_fields=['review_rate_average', 'review_count'])
         messages.success(request, 'Review updated successfully')
         return redirect('/customer/product/details/{}/'.format(review.product.slug))
     else:
@@ -302,58 +303,23 @@ def delete_review(request, review_id):
     review.product.review_rate_average = review_rate_average.get('rate__avg', 0) or 0
     # Update product review count
     review.product.review_count = Review.objects.filter(product=review.product).count()
-    review.product.save()
+    review.product.save(update_fields=['review_rate_average', 'review_count'])
     messages.success(request, 'Review deleted successfully')
     return redirect('/customer/product/details/' + review.product.slug)
 
 
 @login_required(login_url='/auth/login/')
 def add_to_cart(request, slug):
-    if request.method == 'POST':
-        product = Product.objects.get(slug=slug)
-        quantity = int(request.POST.get('quantity'))
-        if quantity > product.stock:
-            messages.warning(request, 'Product stock is not available')
-            return redirect('/customer/product/details/{}/'.format(slug))
-    else:
-        product = Product.objects.get(slug=slug)
-        quantity = 1
-        if quantity > product.stock:
-            messages.warning(request, 'Product stock is not available')
-            return redirect('/customer/product/details/{}/'.format(slug))
+    quantity = int(request.POST.get('quantity')) if request.method == 'POST' else 1
+    customer = request.user.customer
 
-    customer = request.user.customer if request.user.is_authenticated else None
+    # One guarded upsert: the line is created or grown only while the stock covers it
+    status, cart_quantity = cart.add_item(customer, slug, quantity)
+    if status in (cart.OUT_OF_STOCK, cart.NOT_FOUND):
+        messages.warning(request, 'Product stock is not available')
+        return redirect('/customer/product/details/{}/'.format(slug))
 
-    try:
-        cart_item = CartItem.objects.get(customer=customer, product=product)
-    except CartItem.DoesNotExist:
-        cart_item = None
-
-    # Check if coupon is already applied to any of the cart items
-    cart_items = CartItem.objects.filter(customer=customer)
-    coupon_applied = any(cart_item.coupon_applied for cart_item in cart_items)
-
-    if cart_item is None:
-        sub_total = product.price * quantity
-        cart_item = CartItem(customer=customer, product=product, quantity=quantity,
-                             price=product.price, sub_total=sub_total)
-    else:
-        cart_item.quantity += quantity
-        cart_item.sub_total += product.price * quantity
-
-    # Update coupon code if a coupon is already applied to the cart
-    if coupon_applied:
-        applied_coupon = CartItem.objects.filter(customer=customer, coupon_applied=True).first().coupon
-        cart_item.discount = applied_coupon.discount * cart_item.quantity
-        cart_item.coupon = applied_coupon
-        cart_item.coupon.amount = cart_item.coupon.amount - quantity
-        cart_item.coupon.save()
-        cart_item.coupon_applied = True
-        cart_item.sub_total = cart_item.get_total_amount_with_coupon
-
-    cart_item.save()
-
-    if cart_item.quantity == quantity:
+    if status == cart.ADDED:
         messages.success(request, 'Product added to cart successfully')
     else:
         messages.success(request, 'Product quantity updated successfully')
@@ -365,27 +331,14 @@ def add_to_cart(request, slug):
 # view cart function for customer
 def view_cart(request):
     customer = request.user.customer
-    cart_items = CartItem.objects.filter(customer=customer).order_by('-date_added')
-    total = sum(item.sub_total for item in cart_items)
-    total_amount_without_coupon = sum(item.get_total_amount_without_coupon for item in cart_items)
-    total_amount_with_coupon = sum(item.get_total_amount_with_coupon for item in cart_items)
-    #  check if any coupon is applied
-    if cart_items.filter(coupon_applied=True).exists():
-        code = cart_items[0].coupon.code if cart_items[0].coupon_applied is True else None
-        discount = sum(item.get_discount for item in cart_items)
-    else:
-        code = None
-        discount = 0
+    # Cart lines and totals, including the applied coupon code and discount
+    cart_summary = cart.cart_summary(customer)
+    badges.set_badge(request.user.id, badges.CART, len(cart_summary['items']))
 
-    recommended_products = Product.objects.all().order_by('-view_count')[:4]
+    recommended_products = get_leaderboard('view_count')
 
     context = {
-        'cart_items': cart_items,
-        'total': total,
-        'code': code,
-        'discount': discount,
-        'total_amount_without_coupon': total_amount_without_coupon,
-        'total_amount_with_coupon': total_amount_with_coupon,
+        'cart': cart_summary,
         'recommended_products': recommended_products,
     }
     return render(request, 'customer_cart/view_cart.html', context)
@@ -393,18 +346,10 @@ def view_cart(request):
 
 @login_required(login_url='/auth/login/')
 def remove_from_cart(request, slug):
-    # Get the product and customer from the database
-    product = Product.objects.get(slug=slug)
     customer = request.user.customer
 
-    # Get the cart item for the product and customer, and delete it
-    cart_item = CartItem.objects.get(customer=customer, product=product)
-    if cart_item.coupon_applied is True and cart_item.coupon is not None:
-        # restore amount to coupon
-        coupon = cart_item.coupon
-        coupon.amount = coupon.amount + cart_item.quantity
-        coupon.save()
-    cart_item.delete()
+    # Delete the cart item for the product and customer, its coupon units are restored
+    cart.remove_item(customer, slug)
 
     # Show success message and redirect to cart page
     messages.success(request, 'Product removed from cart successfully')
@@ -414,25 +359,11 @@ def remove_from_cart(request, slug):
 
 @login_required(login_url='/auth/login/')
 def add_quantity(request, slug):
-    # Get the product and customer from the database
-    product = Product.objects.get(slug=slug)
     customer = request.user.customer
 
-    # Get the cart item for the product and customer
-    cart_item = CartItem.objects.get(customer=customer, product=product)
-
-    # Check if the quantity can be increased, and update the cart item
-    if cart_item.quantity < product.stock:
-        if cart_item.coupon_applied is True and cart_item.coupon is not None:
-            # restore amount to coupon
-            coupon = cart_item.coupon
-            coupon.amount = coupon.amount + 1
-            coupon.save()
-        cart_item.quantity += 1
-        if cart_item.discount > 0:
-            cart_item.discount = cart_item.coupon.discount * cart_item.quantity
-        cart_item.sub_total += cart_item.price
-        cart_item.save()
+    # Increase the quantity if the stock allows it
+    status, quantity = cart.change_quantity(customer, slug, 1)
+    if status == cart.UPDATED:
         messages.success(request, 'Product quantity updated successfully')
     else:
         messages.success(request, 'Product out of stock')
@@ -444,29 +375,14 @@ def add_quantity(request, slug):
 
 @login_required(login_url='/auth/login/')
 def remove_quantity(request, slug):
-    # Get the product and customer from the database
-    product = Product.objects.get(slug=slug)
     customer = request.user.customer
 
-    # Get the cart item for the product and customer
-    cart_item = CartItem.objects.get(customer=customer, product=product)
-
-    # Check if the quantity can be decreased, and update the cart item or delete it
-    if cart_item.quantity > 1:
-        cart_item.quantity -= 1
-        if cart_item.coupon_applied is True and cart_item.coupon is not None:
-            # restore amount to coupon
-            coupon = cart_item.coupon
-            coupon.amount = coupon.amount - cart_item.quantity + 1
-            coupon.save()
-        if cart_item.discount > 0:
-            cart_item.discount = cart_item.coupon.discount * cart_item.quantity
-        cart_item.sub_total -= cart_item.price
-        cart_item.save()
-        messages.success(request, 'Product quantity updated successfully')
-    else:
-        cart_item.delete()
+    # Decrease the quantity, the cart item is deleted when it was the last unit
+    status, quantity = cart.change_quantity(customer, slug, -1)
+    if status == cart.REMOVED:
         messages.success(request, 'Product removed from cart successfully')
+    else:
+        messages.success(request, 'Product quantity updated successfully')
 
     # Redirect to cart page
     next_url = request.GET.get('next', '/customer/cart/')
@@ -475,44 +391,23 @@ def remove_quantity(request, slug):
 
 @login_required(login_url='/auth/login/')
 def update_quantity(request, slug):
-    # Get the product and customer from the database
-    product = Product.objects.get(slug=slug)
     customer = request.user.customer
 
-    # Get the cart item for the product and customer
-    cart_item = CartItem.objects.get(customer=customer, product=product)
-
     # If the form is submitted
     if request.method == "POST":
         # Get the new quantity value from the form
         quantity = int(request.POST.get('quantity'))
 
         # Update or delete the cart item based on the new quantity
-        if quantity == 0:
-            if cart_item.coupon_applied is True and cart_item.coupon is not None:
-                # restore amount to coupon
-                coupon = cart_item.coupon
-                coupon.amount = coupon.amount + cart_item.quantity - 1
-                coupon.save()
-            cart_item.delete()
-            messages.success(request, 'Product removed from cart successfully')
-        elif quantity < 0:
+        if quantity < 0:
             messages.success(request, 'Quantity cannot be less than 0')
         else:
-            if quantity > product.stock:
+            status, quantity = cart.set_quantity(customer, slug, quantity)
+            if status == cart.REMOVED:
+                messages.success(request, 'Product removed from cart successfully')
+            elif status == cart.OUT_OF_STOCK:
                 messages.success(request, 'Product stock is not available')
-            else:
-                if cart_item.coupon_applied is True and cart_item.coupon is not None:
-                    # restore amount to coupon
-                    coupon = cart_item.coupon
-                    coupon.amount = coupon.amount + cart_item.quantity - quantity
-                    coupon.save()
-                cart_item.quantity = quantity
-                if cart_item.discount > 0:
-                    cart_item.discount = cart_item.coupon.discount * cart_item.quantity
-                cart_item.sub_total = quantity * cart_item.price
-                cart_item.total = cart_item.sub_total
-                cart_item.save()
+            elif status == cart.UPDATED:
                 messages.success(request, 'Product quantity updated successfully')
 
     # Redirect to cart page
@@ -520,49 +415,105 @@ def update_quantity(request, slug):
     return redirect(next_url)
 
 
+# Messages for the JSON cart endpoints, by cart status
+CART_MESSAGES = {
+    cart.UPDATED: 'Product quantity updated successfully',
+    cart.REMOVED: 'Product removed from cart successfully',
+    cart.OUT_OF_STOCK: 'Product stock is not available',
+    cart.NOT_IN_CART: 'Product not found in cart',
+}
+CART_ERROR_STATUS = {
+    cart.OUT_OF_STOCK: 409,
+    cart.NOT_IN_CART: 404,
+}
+
+
+# The changed line (None once removed) and the new cart totals, so the cart page updates in place
+def cart_response(request, slug, status):
+    customer = request.user.customer
+    totals = cart.cart_totals(customer)
+    badges.set_badge(request.user.id, badges.CART, totals['count'])
+    return JsonResponse({
+        'status': status,
+        'message': CART_MESSAGES[status],
+        'line': cart.cart_line(customer, slug),
+        'totals': totals,
+    }, status=CART_ERROR_STATUS.get(status, 200))
+
+
+@login_required(login_url='/auth/login/')
+def add_quantity_json(request, slug):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    status, quantity = cart.change_quantity(request.user.customer, slug, 1)
+    return cart_response(request, slug, status)
+
+
+@login_required(login_url='/auth/login/')
+def remove_quantity_json(request, slug):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    status, quantity = cart.change_quantity(request.user.customer, slug, -1)
+    return cart_response(request, slug, status)
+
+
+@login_required(login_url='/auth/login/')
+def update_quantity_json(request, slug):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    try:
+        quantity = int(request.POST.get('quantity'))
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid quantity'}, status=400)
+    if quantity < 0:
+        return JsonResponse({'error': 'Quantity cannot be less than 0'}, status=400)
+    status, quantity = cart.set_quantity(request.user.customer, slug, quantity)
+    return cart_response(request, slug, status)
+
+
+@login_required(login_url='/auth/login/')
+def remove_from_cart_json(request, slug):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    status, quantity = cart.remove_item(request.user.customer, slug)
+    return cart_response(request, slug, status)
+
+
 @login_required(login_url='/auth/login/')
 def apply_coupon(request):
     if request.method == 'POST':
         coupon_code = request.POST.get('coupon_code')
-        try:
-            # get coupon with condition that it is active and datetime is less than current datetime
-            coupon = Coupon.objects.get(code=coupon_code, is_active=True, valid_from__lte=datetime.now(),
-                                        valid_to__gte=datetime.now())
-            customer = request.user.customer  # get customer
-            cart_items = CartItem.objects.filter(customer=customer)  # get cart items
-            subtotal = sum(item.sub_total for item in cart_items)  # get subtotal
-
-            # Check if coupon is applicable
-            if coupon.amount <= subtotal:
-                # Check if coupon has already been applied to the cart items
-                if any(cart_item.coupon_applied for cart_item in cart_items):
-                    messages.warning(request, 'Coupon has already been applied')
-                    next_url = request.GET.get('next', '/customer/cart/')
-                    return redirect(next_url)
-
-                total_discount = 0
-                for cart_item in cart_items:
-                    # update coupon amount
-                    coupon.amount = coupon.amount - cart_item.quantity
-                    coupon.save()
-                    cart_item.discount = coupon.discount * cart_item.quantity
-                    cart_item.sub_total = cart_item.get_total_amount_with_coupon
-                    cart_item.coupon = coupon
-                    cart_item.coupon_applied = True
-                    cart_item.save()
-                    total_discount += coupon.discount * cart_item.quantity
-
-                messages.success(request, f'Coupon {coupon.code} applied successfully. You saved (${total_discount})')
-                next_url = request.GET.get('next', '/customer/cart/')
-                return redirect(next_url)
-            else:
-                messages.warning(request, 'Coupon is not applicable for this order')
-                next_url = request.GET.get('next', '/customer/cart/')
-                return redirect(next_url)
-        except Coupon.DoesNotExist:
+        # Active coupon valid right now, from the cached coupon metadata
+        coupon = coupons.get_valid_coupon(coupon_code)
+        if coupon is None:
             messages.warning(request, 'Invalid coupon code')
             next_url = request.GET.get('next', '/customer/cart/')
             return redirect(next_url)
+        customer = request.user.customer  # get customer
+        # get item count and whether a coupon is applied in one aggregate query
+        cart_totals = CartItem.objects.filter(customer=customer).aggregate(
+            quantity=Coalesce(Sum('quantity'), 0), applied=Count('id', filter=Q(coupon_applied=True)))
+
+        # Check if coupon has already been applied to the cart items
+        if cart_totals['applied']:
+            messages.warning(request, 'Coupon has already been applied')
+            next_url = request.GET.get('next', '/customer/cart/')
+            return redirect(next_url)
+        if not cart_totals['quantity']:
+            messages.warning(request, 'Coupon is not applicable for this order')
+            next_url = request.GET.get('next', '/customer/cart/')
+            return redirect(next_url)
+
+        # Reserve one coupon unit per item with a guarded UPDATE, then reprice the cart in one UPDATE
+        if not coupons.apply_cart_coupon(customer, coupon, cart_totals['quantity']):
+            messages.warning(request, 'Coupon {} has been fully redeemed'.format(coupon.code))
+            next_url = request.GET.get('next', '/customer/cart/')
+            return redirect(next_url)
+        total_discount = coupon.discount * cart_totals['quantity']
+
+        messages.success(request, f'Coupon {coupon.code} applied successfully. You saved (${total_discount})')
+        next_url = request.GET.get('next', '/customer/cart/')
+        return redirect(next_url)
     else:
         messages.warning(request, 'Invalid request')
         next_url = request.GET.get('next', '/customer/cart/')
@@ -572,17 +523,8 @@ def apply_coupon(request):
 @login_required(login_url='/auth/login/')
 def remove_coupon(request):
     customer = request.user.customer
-    cart_items = CartItem.objects.filter(customer=customer)
-    coupon = Coupon.objects.get(code=cart_items[0].coupon.code)
-    for cart_item in cart_items:
-        # restore amount to coupon
-        coupon.amount = coupon.amount + cart_item.quantity
-        coupon.save()
-        cart_item.discount = 0
-        cart_item.sub_total = cart_item.get_total_amount_without_coupon
-        cart_item.coupon = None
-        cart_item.coupon_applied = False
-        cart_item.save()
+    # Restore the reserved units to the coupon and reprice the cart in one UPDATE
+    coupons.clear_cart_coupon(customer)
 
     messages.success(request, 'Coupon removed successfully')
     next_url = request.GET.get('next', '/customer/cart/')
@@ -599,6 +541,7 @@ def add_to_wishlist(request, slug):
     # check if the product is already in the wishlist
     wishlist_item, created = Wishlist.objects.get_or_create(customer=customer, product=product)
     if created:
+        badges.adjust_badge(request.user.id, badges.WISHLIST, 1)
         messages.success(request, 'Product added to wishlist successfully. You can view it in your wishlist')
         return redirect('/')
     else:
@@ -610,8 +553,9 @@ def add_to_wishlist(request, slug):
 @login_required(login_url='/auth/login/')
 def view_wishlist(request):
     customer = request.user.customer
-    wishlists = Wishlist.objects.filter(customer=customer).order_by('-date_added')
-    recommended_products = Product.objects.all().order_by('-view_count')[:4]
+    wishlists = list(Wishlist.objects.filter(customer=customer).order_by('-date_added'))
+    badges.set_badge(request.user.id, badges.WISHLIST, len(wishlists))
+    recommended_products = get_leaderboard('view_count')
     context = {
         'wishlists': wishlists,
         'recommended_products': recommended_products
@@ -628,6 +572,7 @@ def remove_from_wishlist(request, slug):
     try:
         wishlist_item = Wishlist.objects.get(customer=customer, product=product)
         wishlist_item.delete()
+        badges.adjust_badge(request.user.id, badges.WISHLIST, -1)
         messages.success(request, 'Product removed from wishlist successfully')
     except Wishlist.DoesNotExist:
         messages.warning(request, 'Product not found in wishlist')
@@ -638,26 +583,13 @@ def remove_from_wishlist(request, slug):
 @login_required(login_url='/auth/login/')
 def add_all_to_cart_form_wishlist(request):
     customer = request.user.customer
-    wishlists = customer.wishlist_set.all()
-    for item in wishlists:
-        product = item.product
-        price = product.price
-        quantity = 1
-        sub_total = price * quantity
-        # check if the product is already in the cart
-        cart_item, created = CartItem.objects.get_or_create(customer=customer, product=product)
-        if created:
-            cart_item.quantity = quantity
-            cart_item.price = price
-            cart_item.sub_total = sub_total
-            cart_item.save()
-            wishlists.delete()
-        else:
-            cart_item.quantity += quantity
-            cart_item.price = price
-            cart_item.sub_total += sub_total
-            cart_item.save()
-            wishlists.delete()
+    # One upsert moves the whole wishlist into the cart, then the moved products leave the wishlist
+    moved, kept = cart.add_wishlist(customer)
+    badges.forget_badges(request.user.id)
+    if kept:
+        messages.warning(request, '{} products added to cart, {} products are out of stock and stay in your '
+                                  'wishlist'.format(moved, kept))
+        return redirect('/customer/wishlist/')
     messages.success(request, 'All products added to cart successfully')
     return redirect('/customer/cart/')
 
@@ -665,10 +597,14 @@ def add_all_to_cart_form_wishlist(request):
 # checkout function for customer
 @login_required(login_url='/auth/login/')
 def checkout(request):
-    # check if the cart is empty
     customer = request.user.customer
-    cart_items = CartItem.objects.filter(customer=customer)
-    if cart_items.count() == 0:
+    # A repeated submit of the same checkout form (double click, retry) gets the order it already placed
+    checkout_token = clean_checkout_token(request.POST.get('checkout_token')) if request.method == 'POST' else None
+    order = placed_order(customer, checkout_token)
+    if order is not None:
+        return render(request, 'customer_cart/orders_success.html', {'order': order})
+    # check if the cart is empty
+    if not CartItem.objects.filter(customer=customer).exists():
         messages.warning(request, 'Your cart is empty. Please add some products to your cart to checkout')
         return redirect('/customer/cart/')
     else:
@@ -676,103 +612,66 @@ def checkout(request):
         customer = user.customer
         payment_methods = Payment.METHOD_CHOICES
         delivery_address = DeliveryAddress.objects.filter(customer=customer)
-        cart_items = CartItem.objects.filter(customer=customer)
-        # Auto create transaction_id for order
-        transaction_id = datetime.now().timestamp()
         if request.method == 'POST':
             # Save delivery address that customer selected
             delivery_address_id = request.POST.get('delivery_address')
-            delivery_address = DeliveryAddress.objects.get(id=delivery_address_id)
+            delivery_address = DeliveryAddress.objects.get(id=delivery_address_id, customer=customer)
             # Save payment method that customer selected
             payment_method = request.POST.get('payment_method')
-            total_profit = sum(
-                [(cart_item.product.price - cart_item.product.price_original) * cart_item.quantity - cart_item.discount
-                 for cart_item in
-                 cart_items])
-
-            # Save orders
-            order = Orders.objects.create(
-                customer=customer,
-                status='Pending',
-                sub_total=sum([cart_item.sub_total for cart_item in cart_items]),
-                total_discount=sum([cart_item.discount for cart_item in cart_items]),
-                total_amount=sum([cart_item.sub_total for cart_item in cart_items]) - sum(
-                    [cart_item.discount for cart_item in cart_items]),
-                delivery_address=delivery_address,
-            )
-            order.profit_order = total_profit
-            order.save()
-
-            # Save OrderDetails for each item in the cart
-            for cart_item in cart_items:
-                OrderDetails.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    quantity=cart_item.quantity,
-                    price=cart_item.price,
-                    sub_total=cart_item.sub_total,
-                    discount=cart_item.discount,
-                    coupon=cart_item.coupon,
-                    coupon_applied=cart_item.coupon_applied,
-                )
-            # Save payment details
-            Payment.objects.create(
-                customer=customer,
-                order=order,
-                payment_method=payment_method,
-                payment_status='Pending',
-                total=sum([cart_item.sub_total for cart_item in cart_items]) - sum(
-                    cart_item.discount for cart_item in cart_items),
-                transaction_id=int(transaction_id),
-            )
-            # Update product stock and sold
-            for cart_item in cart_items:
-                product = cart_item.product
-                product.stock -= cart_item.quantity
-                product.sold += cart_item.quantity
-                product.profit += (cart_item.product.price - cart_item.product.price_original) \
-                                  * cart_item.quantity - cart_item.discount
-                product.save()
-            # Delete cart items
-            cart_items.delete()
-            # Send email to admin
-            customer = request.user.customer
-            order = Orders.objects.filter(customer=customer, status='Pending').last()
-            order_details = OrderDetails.objects.filter(order=order)
-            # get admin email first
-            admin = User.objects.get(is_superuser=True, email='lclshop.dev@gmail.com')
-            send_email_order_admin(request, admin.email, order, order_details, customer)
-            # Send email to customer
-            send_email_order_customer(request, delivery_address.email, order, order_details, customer)
-            send_email_order_customer(request, user.email, order, order_details, customer)
+
+            # Order, order lines, payment, stock, coupon redemption and the order emails in one transaction
+            try:
+                with transaction.atomic():
+                    order, order_details = place_order(customer, delivery_address, payment_method, checkout_token)
+                    if order is not None:
+                        # Queue email to admin, a missing admin account must not fail the order
+                        admin = User.objects.filter(is_superuser=True, email='lclshop.dev@gmail.com').first()
+                        if admin is not None:
+                            send_email_order_admin(request, admin.email, order, order_details, customer)
+                        # Queue email to customer
+                        send_email_order_customer(request, delivery_address.email, order, order_details, customer)
+                        send_email_order_customer(request, user.email, order, order_details, customer)
+            except OutOfStock as error:
+                messages.warning(request, 'Product {} does not have enough stock for your order'.format(
+                    error.product.name))
+                return redirect('/customer/cart/')
+            except IntegrityError:
+                # A concurrent submit of the same form placed the order first
+                order = placed_order(customer, checkout_token)
+                if order is not None:
+                    return render(request, 'customer_cart/orders_success.html', {'order': order})
+                # Any other clash rolled the whole order back, the cart is untouched and can be submitted again
+                messages.warning(request, 'Your order could not be placed. Please try again')
+                return redirect('/customer/checkout/')
+            if order is None:
+                # The cart was emptied by a concurrent submit of the same form, show the order it placed
+                order = placed_order(customer, checkout_token)
+                if order is not None:
+                    return render(request, 'customer_cart/orders_success.html', {'order': order})
+                messages.warning(request, 'Your cart is empty. Please add some products to your cart to checkout')
+                return redirect('/customer/cart/')
+            badges.set_badge(request.user.id, badges.CART, 0)
             messages.success(request, 'Order placed successfully')
             context = {
                 'order': order,
             }
             return render(request, 'customer_cart/orders_success.html', context)
-        # Display Cart Items in the checkout page
-        cart_items = CartItem.objects.filter(customer=customer).order_by('-date_added')
-        total = sum(item.sub_total for item in cart_items)
-        total_amount_without_coupon = sum(item.get_total_amount_without_coupon for item in cart_items)
-        total_amount_with_coupon = sum(item.get_total_amount_with_coupon for item in cart_items)
-        #  check if any coupon is applied
-        if cart_items.filter(coupon_applied=True).exists():
-            code = cart_items[0].coupon.code if cart_items[0].coupon_applied is True else None
-            discount = sum(item.get_discount for item in cart_items)
-        else:
-            code = None
-            discount = 0
-        recommended_products = Product.objects.all().order_by('-view_count')[:4]
+        # Hold the cart stock while the customer fills in the checkout page
+        short = inventory.hold_cart(customer)
+        if short:
+            messages.warning(request, 'Product {} does not have enough stock for your order'.format(
+                ', '.join(product.name for product in short)))
+            return redirect('/customer/cart/')
+        # Display Cart Items and totals in the checkout page
+        cart_summary = cart.cart_summary(customer)
+        badges.set_badge(request.user.id, badges.CART, len(cart_summary['items']))
+        recommended_products = get_leaderboard('view_count')
         context = {
-            'cart_items': cart_items,
-            'total': total,
-            'code': code,
-            'discount': discount,
-            'total_amount_without_coupon': total_amount_without_coupon,
-            'total_amount_with_coupon': total_amount_with_coupon,
+            'cart': cart_summary,
             'delivery_address': delivery_address,
             'payment_methods': payment_methods,
             'recommended_products': recommended_products,
+            'checkout_token': new_checkout_token(),
         }
         return render(request, 'customer_checkout/checkout.html', context)
 
@@ -792,7 +691,7 @@ def send_email_order_admin(request, email, order, order_details, customer):
     from_email = 'LCL Shop <lclshop.dev@gmail.com>'
     email = EmailMessage(mail_subject, message, from_email, to_email)
     email.content_subtype = "html"
-    email.send()
+    outbox.queue(email)
 
 
 def send_email_order_customer(request, email, order, order_details, customer):
@@ -810,14 +709,15 @@ def send_email_order_customer(request, email, order, order_details, customer):
     from_email = 'LCL Shop <lclshop.dev@gmail.com>'
     email = EmailMessage(mail_subject, message, from_email, to_email)
     email.content_subtype = "html"
-    email.send()
+    outbox.queue(email)
 
 
 @login_required(login_url='/auth/login/')
 def track_orders(request):
     customer = request.user.customer
-    orders = Orders.objects.filter(customer=customer).order_by('-id')
-    page_object = paginator(request, orders)
+    orders = Orders.objects.filter(customer=customer)
+    # A customer's order history needs no total, so the filtered listing is never counted
+    page_object = paginator(request, orders, ordering='-id', with_count=False)
     context = {'orders': page_object}
 
     return render(request, 'customer_orders/track_orders.html', context)
@@ -942,9 +842,10 @@ def cancel_order(request, order_id):
         product.stock += order_detail.quantity
         product.profit -= (order_detail.product.price - order_detail.product.price_original) \
                           * order_detail.quantity - order_detail.discount
-        product.save()
+        product.save(update_fields=['stock', 'sold', 'profit'])
 
-    # Delete order
+    # Delete order, its coupon units go back to the coupon
+    coupons.release_order(order)
     order.delete()
     messages.success(request, 'Order {} deleted successfully!'.format(order_id))
     return redirect('/customer/track_orders/')
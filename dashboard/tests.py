@@ -1,3 +1,55 @@
+from django.contrib.auth.models import User
 from django.test import TestCase
+from main import order_status
+from main.models import Orders, Payment
 
-# Create your tests here.
+
+class BulkStatusTest(TestCase):
+    def setUp(self):
+        admin = User.objects.create_user(username='admin', email='admin@example.com', password='secret',
+                                         is_staff=True, is_superuser=True)
+        self.client.force_login(admin)
+
+    def create_orders(self, count, status='Pending'):
+        return [order.id for order in Orders.objects.bulk_create(
+            [Orders(status=status, sub_total=10, total_discount=0, total_amount=10) for _ in range(count)])]
+
+    def update_orders(self, ids, status):
+        return self.client.post('/dashboard/order/bulk_update_status/', {'ids': ids, 'status': status})
+
+    def test_every_selected_id_gets_a_result(self):
+        pending = self.create_orders(2)
+        delivered = self.create_orders(1, status='Delivered')
+        missing = max(pending + delivered) + 1
+        response = self.update_orders(pending + delivered + [missing], order_status.NEXT)
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(response.json()['updated'], 2)
+        self.assertEqual({int(row_id): result['result'] for row_id, result in results.items()}, {
+            pending[0]: order_status.UPDATED,
+            pending[1]: order_status.UPDATED,
+            delivered[0]: order_status.NOT_ALLOWED,
+            missing: order_status.NOT_FOUND,
+        })
+        self.assertEqual(list(Orders.objects.filter(id__in=pending).values_list('status', flat=True).distinct()),
+                         ['Order Confirmed'])
+
+    def test_selection_over_the_limit_is_refused(self):
+        ids = self.create_orders(order_status.MAX_SELECTION + 1)
+        response = self.update_orders(ids, 'Order Confirmed')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+        with self.assertRaises(ValueError):
+            order_status.change_order_status(ids, 'Order Confirmed')
+        self.assertFalse(Orders.objects.exclude(status='Pending').exists())
+
+    def test_payment_status_moves_only_along_its_transitions(self):
+        order = Orders.objects.create(status='Pending')
+        paid = Payment.objects.create(order=order, payment_status='Paid', total=10, transaction_id='1')
+        due = Payment.objects.create(order=order, payment_status='Due', total=10, transaction_id='2')
+        response = self.client.post('/dashboard/payment/bulk_update_status/',
+                                    {'ids': [paid.id, due.id], 'status': 'Paid'})
+        results = response.json()['results']
+        self.assertEqual(results[str(paid.id)]['result'], order_status.UNCHANGED)
+        self.assertEqual(results[str(due.id)]['result'], order_status.UPDATED)
+        self.assertEqual(Payment.objects.get(id=due.id).payment_status, 'Paid')
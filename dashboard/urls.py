@@ -82,6 +82,7 @@ urlpatterns = [
     path('order/', views.order_table, name='order_table'),
     path('order/details/<int:order_id>/', views.order_details, name='order_details'),
     path('order/update_status/<int:order_id>/', views.update_order_status, name='update_order_status'),
+    path('order/bulk_update_status/', views.bulk_update_order_status, name='bulk_update_order_status'),
     path('order/delete/<int:order_id>/', views.delete_order, name='delete_order'),
     path('order/delete_selected/<str:order_ids>/', views.delete_selected_order,
          name='delete_selected_order'),
@@ -107,6 +108,7 @@ urlpatterns = [
     path('payment/details/<int:payment_id>/', views.payment_details, name='payment_details'),
     path('payment/search/', views.search_payment, name='search_payment'),
     path('payment/update_status/<int:payment_id>/', views.update_payment_status, name='update_payment_status'),
+    path('payment/bulk_update_status/', views.bulk_update_payment_status, name='bulk_update_payment_status'),
     path('payment/export/csv/', views.export_payment_csv, name='export_payment_csv'),
     path('payment/export/excel/', views.export_payment_excel, name='export_payment_excel'),
     path('payment/export/json/', views.export_payment_json, name='export_payment_json'),
@@ -3,6 +3,9 @@ from datetime import datetime
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator
+from main.pagination import KeysetPaginator
+from main.leaderboards import get_leaderboard
+from main import coupons, order_status, outbox
 from django.contrib.auth import authenticate, update_session_auth_hash, logout as auth_logout
 from django.contrib.sites.shortcuts import get_current_site
 from django.db.models import Avg
@@ -141,10 +144,14 @@ def dashboard(request):
 
 
 # Pagination function
-def paginator(request, objects):
+def paginator(request, objects, ordering=None, with_count=True):
     # Set the number of items per page
     per_page = 10
 
+    # Keyset mode: seek on (ordering, id) from the opaque cursor in the request's GET parameters
+    if ordering:
+        return KeysetPaginator(objects, per_page, ordering, with_count).get_page(request.GET.get('cursor'))
+
     # Create a Paginator object with the customers queryset and the per_page value
     page = Paginator(objects, per_page)
 
@@ -210,7 +217,7 @@ def send_verify_new_email(request, user):
     form_email = 'LCL Shop <lclshop.dev@gmail.com>'
     email = EmailMessage(mail_subject, message, form_email, to_email)
     email.content_subtype = "html"
-    email.send()
+    outbox.queue(email)
 
 
 # activate new email
@@ -1069,8 +1076,8 @@ def search_coupon(request):
 @login_required(login_url='/auth/login/')
 def order_table(request):
     # Get all orders
-    orders = Orders.objects.all().order_by('-id')
-    page_object = paginator(request, orders)
+    orders = Orders.objects.all()
+    page_object = paginator(request, orders, ordering='-id')
     context = {'orders': page_object}
     return render(request, 'dashboard/manage_order/order_table.html', context)
 
@@ -1131,6 +1138,40 @@ def update_order_status(request, order_id):
     return render(request, 'dashboard/manage_order/update_order_status.html', context)
 
 
+# Validate a bulk status change request and apply it, per id results as JSON
+def bulk_status_response(request, change_status, transitions, name):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    try:
+        ids = list(dict.fromkeys(int(row_id) for row_id in request.POST.getlist('ids')))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid {} id'.format(name)}, status=400)
+    target = request.POST.get('status', '')
+    if not ids:
+        return JsonResponse({'error': 'Please select at least one {}!'.format(name)}, status=400)
+    # Every selected id gets a result, so a selection too large to change at once is refused as a whole
+    if len(ids) > order_status.MAX_SELECTION:
+        return JsonResponse({'error': 'Please select at most {} {}s!'.format(order_status.MAX_SELECTION, name)},
+                            status=400)
+    if target != order_status.NEXT and target not in transitions:
+        return JsonResponse({'error': 'Invalid status {}'.format(target)}, status=400)
+    results = change_status(ids, target)
+    updated = sum(1 for result in results.values() if result['result'] == order_status.UPDATED)
+    if updated:
+        messages.success(request, '{} {}(s) updated successfully!'.format(updated, name))
+    if len(results) > updated:
+        messages.warning(request, '{} {}(s) left unchanged: already in this status, missing or not allowed to '
+                                  'move to it'.format(len(results) - updated, name))
+    return JsonResponse({'updated': updated, 'results': results})
+
+
+# Move the selected orders to a status, or each to its next status
+@user_passes_test(is_admin, login_url='/auth/login/')
+@login_required(login_url='/auth/login/')
+def bulk_update_order_status(request):
+    return bulk_status_response(request, order_status.change_order_status, order_status.ORDER_TRANSITIONS, 'order')
+
+
 # Delete order
 @user_passes_test(is_admin, login_url='/auth/login/')
 @login_required(login_url='/auth/login/')
@@ -1148,9 +1189,10 @@ def delete_order(request, order_id):
         product.stock += order_detail.quantity
         product.profit -= (order_detail.product.price - order_detail.product.price_original) \
                           * order_detail.quantity - order_detail.discount
-        product.save()
+        product.save(update_fields=['stock', 'sold', 'profit'])
 
-    # Delete order
+    # Delete order, its coupon units go back to the coupon
+    coupons.release_order(order)
     order.delete()
     messages.success(request, 'Order {} deleted successfully!'.format(order_id))
     return redirect('/dashboard/order/')
@@ -1175,8 +1217,9 @@ def delete_selected_order(request, order_ids):
                         product.sold -= order_detail.quantity
                         product.stock += order_detail.quantity
                         product.profit -= order_detail.quantity * order_detail.price
-                        product.save()
+                        product.save(update_fields=['stock', 'sold', 'profit'])
 
+                    coupons.release_order(order)
                     order.delete()
                 except ObjectDoesNotExist:
                     messages.warning(request, f'The order with ID {order_id} does not exist!')
@@ -2239,8 +2282,8 @@ def export_order_json(request):
 @user_passes_test(is_admin, login_url='/auth/login/')
 @login_required(login_url='/auth/login/')
 def payment_table(request):
-    payments = Payment.objects.all().order_by('-id')
-    page_object = paginator(request, payments)
+    payments = Payment.objects.all()
+    page_object = paginator(request, payments, ordering='-id')
 
     context = {
         'payments': page_object,
@@ -2302,12 +2345,20 @@ def update_payment_status(request, payment_id):
     return render(request, 'dashboard/manage_payment/update_payment_status.html', context)
 
 
+# Move the selected payments to a status, or each to its next status
+@user_passes_test(is_admin, login_url='/auth/login/')
+@login_required(login_url='/auth/login/')
+def bulk_update_payment_status(request):
+    return bulk_status_response(request, order_status.change_payment_status, order_status.PAYMENT_TRANSITIONS,
+                                'payment')
+
+
 # Review Management
 @user_passes_test(is_admin, login_url='/auth/login/')
 @login_required(login_url='/auth/login/')
 def review_table(request):
-    reviews = Review.objects.all().order_by('-id')
-    page_object = paginator(request, reviews)
+    reviews = Review.objects.all()
+    page_object = paginator(request, reviews, ordering='-id')
     context = {
         'reviews': page_object}
     return render(request, 'dashboard/manage_review/review_table.html', context)
@@ -2488,16 +2539,16 @@ def sales_statistics(request):
     total_review_rate = round(total_review_rate, 1)
 
     # Top 10 Best Selling Products
-    top_10_best_selling_products = Product.objects.all().order_by('-sold')[:10]
+    top_10_best_selling_products = get_leaderboard('sold', size=10)
 
     # Top 10 Profitable Products
-    top_10_profitable_products = Product.objects.all().order_by('-profit')[:10]
+    top_10_profitable_products = get_leaderboard('profit', size=10)
 
     # Top 10 Most Viewed Products
-    top_10_most_viewed_products = Product.objects.all().order_by('-view_count')[:10]
+    top_10_most_viewed_products = get_leaderboard('view_count', size=10)
 
     # Top 10 Rated Products
-    top_10_rated_products = Product.objects.all().order_by('-review_rate_average')[:10]
+    top_10_rated_products = get_leaderboard('review_rate_average', size=10)
 
     # Chart
     data_profit = Orders.objects.annotate(month=TruncMonth('order_date')).values('month').annotate(
@@ -2735,16 +2786,16 @@ def sales_statistics_filter(request):
             view_count += product.view_count
 
         # Top 10 Best Selling Products
-        top_10_best_selling_products = Product.objects.all().order_by('-sold')[:10]
+        top_10_best_selling_products = get_leaderboard('sold', size=10)
 
         # Top 10 Profitable Products
-        top_10_profitable_products = Product.objects.all().order_by('-profit')[:10]
+        top_10_profitable_products = get_leaderboard('profit', size=10)
 
         # Top 10 Most Viewed Products
-        top_10_most_viewed_products = Product.objects.all().order_by('-view_count')[:10]
+        top_10_most_viewed_products = get_leaderboard('view_count', size=10)
 
         # Top 10 Rated Products
-        top_10_rated_products = Product.objects.all().order_by('-review_rate_average')[:10]
+        top_10_rated_products = get_leaderboard('review_rate_average', size=10)
 
         # Chart
         data_profit = Orders.objects.annotate(month=TruncMonth('order_date')).values('month').annotate(
@@ -0,0 +1,111 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from django.db.models import Sum
+from .cache import get_catalog_version
+from .models import Category, Brand, Product
+
+# Search-as-you-type suggestions served from a per-process prefix index: a sorted array of (term, entry) pairs
+# searched with bisect, so a lookup never touches the database. The index is rebuilt when the catalog version
+# changes (bumped by the catalog signals) and at least every REBUILD_INTERVAL seconds to pick up sales.
+# A rebuild makes a new immutable Index and swaps the module reference in one assignment: readers take no lock,
+# each lookup works on the one index it read. The lock only keeps two threads from rebuilding at once.
+AUTOCOMPLETE_LIMIT = 8
+REBUILD_INTERVAL = 60 * 10
+
+Index = namedtuple('Index', ['version', 'built', 'terms', 'entries'])
+
+_lock = threading.Lock()
+_index = Index(version=None, built=0, terms=(), entries=())
+
+
+def normalize(text):
+    return ' '.join((text or '').lower().replace('-', ' ').split())
+
+
+def entry_terms(*texts):
+    # Every word of the name and slug, plus the whole name, so both 'gal' and 'samsung gal' match
+    terms = set()
+    for text in texts:
+        text = normalize(text)
+        if text:
+            terms.add(text)
+            terms.update(text.split())
+    return frozenset(terms)
+
+
+def build_entries():
+    entries = []
+    for product in Product.objects.order_by('id').values('id', 'name', 'slug', 'sold'):
+        entries.append({'type': 'product', 'name': product['name'], 'sold': product['sold'],
+                        'url': '/customer/product/details/{}/'.format(product['slug']),
+                        'terms': entry_terms(product['name'], product['slug'])})
+    # Brands and categories rank by the sales of their products
+    for model, kind in ((Brand, 'brand'), (Category, 'category')):
+        for item in model.objects.annotate(sold=Sum('product__sold')).order_by('id').values('name', 'slug', 'sold'):
+            entries.append({'type': kind, 'name': item['name'], 'sold': item['sold'] or 0,
+                            'url': '/customer/product/{}/{}/'.format(kind, item['slug']),
+                            'terms': entry_terms(item['name'], item['slug'])})
+    return entries
+
+
+def build_index(entries):
+    pairs = sorted((term, position) for position, entry in enumerate(entries) for term in entry['terms'])
+    return [term for term, _ in pairs], [position for _, position in pairs]
+
+
+def rebuild_index(version=None):
+    global _index
+    if version is None:
+        version = get_catalog_version()
+    entries = build_entries()
+    terms, positions = build_index(entries)
+    _index = Index(version=version, built=time.monotonic(), terms=tuple(terms),
+                   entries=tuple(entries[position] for position in positions))
+    return _index
+
+
+def is_stale(index, version):
+    return index.version != version or time.monotonic() - index.built > REBUILD_INTERVAL
+
+
+def get_index():
+    index = _index
+    version = get_catalog_version()
+    if is_stale(index, version):
+        with _lock:
+            # Another thread may have rebuilt it while this one waited
+            index = _index
+            if is_stale(index, version):
+                index = rebuild_index(version)
+    return index
+
+
+def lookup(prefix, index):
+    terms, entries = index.terms, index.entries
+    start = bisect_left(terms, prefix)
+    end = start
+    while end < len(terms) and terms[end].startswith(prefix):
+        end += 1
+    return entries[start:end]
+
+
+def suggest(query, limit=AUTOCOMPLETE_LIMIT):
+    query = normalize(query)
+    if not query:
+        return []
+    index = get_index()
+    words = query.split()
+    # Seek on the whole query, falling back to the longest word; every other word must prefix one of the terms
+    candidates = lookup(query, index) or lookup(max(words, key=len), index)
+    seen = set()
+    matches = []
+    for entry in candidates:
+        if id(entry) in seen:
+            continue
+        seen.add(id(entry))
+        if all(any(term.startswith(word) for term in entry['terms']) for word in words):
+            matches.append(entry)
+    matches.sort(key=lambda entry: (-entry['sold'], entry['name']))
+    return [{'type': entry['type'], 'name': entry['name'], 'url': entry['url']} for entry in matches[:limit]]
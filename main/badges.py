@@ -0,0 +1,50 @@
+from django.core.cache import cache
+from .models import CartItem, Wishlist
+
+# Cart and wishlist counts shown in the header, kept in the cache per user and moved by the views that add or
+# remove lines. Counts are recounted when missing and expire after BADGE_TIMEOUT, the cart and wishlist pages
+# also store the exact count they just loaded, so any drift is short-lived.
+CART = 'cart'
+WISHLIST = 'wishlist'
+BADGE_KEY = 'customer:badge:{user_id}:{badge}'
+BADGE_TIMEOUT = 60 * 10
+
+
+def badge_key(user_id, badge):
+    return BADGE_KEY.format(user_id=user_id, badge=badge)
+
+
+def count_badges(user_id):
+    return {
+        CART: CartItem.objects.filter(customer__user_id=user_id).count(),
+        WISHLIST: Wishlist.objects.filter(customer__user_id=user_id).count(),
+    }
+
+
+def get_badges(user_id):
+    keys = {badge_key(user_id, badge): badge for badge in (CART, WISHLIST)}
+    cached = cache.get_many(keys)
+    if len(cached) == len(keys):
+        return {keys[key]: count for key, count in cached.items()}
+    counts = count_badges(user_id)
+    cache.set_many({badge_key(user_id, badge): count for badge, count in counts.items()}, timeout=BADGE_TIMEOUT)
+    return counts
+
+
+def set_badge(user_id, badge, count):
+    cache.set(badge_key(user_id, badge), count, timeout=BADGE_TIMEOUT)
+
+
+def adjust_badge(user_id, badge, delta):
+    key = badge_key(user_id, badge)
+    try:
+        count = cache.incr(key, delta)
+    except ValueError:
+        # Not cached, the next render recounts
+        return
+    if count < 0:
+        cache.delete(key)
+
+
+def forget_badges(*user_ids):
+    cache.delete_many([badge_key(user_id, badge) for user_id in user_ids for badge in (CART, WISHLIST)])
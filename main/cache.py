@@ -0,0 +1,77 @@
+import time
+from django.core.cache import cache
+from .models import Category, Brand, Product
+
+# Version keys, bumped to invalidate every cache entry built from the data they cover
+# Navigation: categories, brands and their product counts
+NAVIGATION_VERSION_KEY = 'catalog:navigation:version'
+# Catalog: any product, category or brand field shown on the storefront
+CATALOG_VERSION_KEY = 'catalog:version'
+
+NAVIGATION_KEY = 'catalog:navigation:{version}'
+# Safety net so that a process that missed a version bump still refreshes eventually
+NAVIGATION_TIMEOUT = 60 * 15
+
+
+# A missing version (first use or evicted) restarts from the current time, never from a value used before
+def new_version():
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, new_version(), timeout=None)
+        version = cache.get(key, 0)
+    return version
+
+
+def get_versions(keys):
+    versions = cache.get_many(keys)
+    return [versions[key] if key in versions else get_version(key) for key in keys]
+
+
+def bump_version(key):
+    # Old entries are never read again once the version changes, they simply expire
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, new_version(), timeout=None)
+
+
+def get_navigation_version():
+    return get_version(NAVIGATION_VERSION_KEY)
+
+
+def bump_navigation_version():
+    bump_version(NAVIGATION_VERSION_KEY)
+
+
+def get_catalog_version():
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    bump_version(CATALOG_VERSION_KEY)
+
+
+def build_navigation():
+    categories = list(Category.objects.with_product_count().order_by('id')
+                      .values('id', 'name', 'slug', 'product_count'))
+    brands = list(Brand.objects.with_product_count().order_by('id')
+                  .values('id', 'name', 'slug', 'product_count'))
+    return {
+        'categories': categories,
+        'brands': brands,
+        'get_products': Product.objects.count(),
+    }
+
+
+# Get the navigation payload, building it at most once per catalog version
+def get_navigation():
+    key = NAVIGATION_KEY.format(version=get_navigation_version())
+    navigation = cache.get(key)
+    if navigation is None:
+        navigation = build_navigation()
+        cache.set(key, navigation, timeout=NAVIGATION_TIMEOUT)
+    return navigation
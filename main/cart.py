@@ -0,0 +1,249 @@
+from decimal import Decimal
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, F, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from . import badges, coupons
+from .models import CartItem, Customer, Product, Wishlist
+
+# Cart mutations as single guarded statements. Quantity, discount and sub total of a line are recomputed in the
+# same UPDATE (or INSERT ... ON CONFLICT for adds) that checks the product stock, so concurrent requests cannot
+# lose updates and an action costs one statement, plus one lookup to explain a rejected change.
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+OUT_OF_STOCK = 'out_of_stock'
+NOT_IN_CART = 'not_in_cart'
+NOT_FOUND = 'not_found'
+
+MONEY = DecimalField(max_digits=10, decimal_places=1)
+ZERO = Value(Decimal(0), output_field=MONEY)
+
+# Line discount for a quantity expression, from the coupon applied to the line
+LINE_DISCOUNT = """
+    CASE WHEN "CartItem".coupon_applied
+    THEN coalesce((SELECT discount FROM "Coupon" WHERE id = "CartItem".coupon_id), 0) * ({quantity})
+    ELSE 0 END
+"""
+
+LINE_VALUES = """
+    quantity = {quantity},
+    discount = {discount},
+    sub_total = "CartItem".price * ({quantity}) - {discount}
+"""
+
+PRODUCT_ID = '(SELECT id FROM "Product" WHERE slug = %s)'
+PRODUCT_STOCK = '(SELECT stock FROM "Product" WHERE id = "CartItem".product_id)'
+RETURNING = 'RETURNING quantity, coupon_id, coupon_applied'
+
+# New lines take the product price and the coupon already applied to the cart, existing lines grow in place
+ADD_SQL = """
+    INSERT INTO "CartItem" (customer_id, product_id, quantity, price, sub_total, discount, date_added,
+                            coupon_id, coupon_applied)
+    SELECT %s, p.id, %s, p.price, p.price * %s - coalesce(c.discount, 0) * %s, coalesce(c.discount, 0) * %s, %s,
+           c.id, c.id IS NOT NULL
+    FROM "Product" p
+    LEFT JOIN "Coupon" c ON c.id = (SELECT coupon_id FROM "CartItem"
+                                    WHERE customer_id = %s AND coupon_applied LIMIT 1)
+    WHERE p.slug = %s AND p.stock >= %s
+    ON CONFLICT (customer_id, product_id) DO UPDATE SET {values}
+    WHERE "CartItem".quantity + excluded.quantity <= {stock}
+    {returning}
+""".format(values=LINE_VALUES.format(quantity='"CartItem".quantity + excluded.quantity',
+                                     discount=LINE_DISCOUNT.format(quantity='"CartItem".quantity + excluded.quantity')),
+           stock=PRODUCT_STOCK, returning=RETURNING)
+
+# Only increases are checked against the stock
+CHANGE_SQL = """
+    UPDATE "CartItem" SET {values}
+    WHERE customer_id = %s AND product_id = {product} AND quantity + %s >= 1 AND (%s <= 0 OR quantity + %s <= {stock})
+    {returning}
+""".format(values=LINE_VALUES.format(quantity='"CartItem".quantity + %s',
+                                     discount=LINE_DISCOUNT.format(quantity='"CartItem".quantity + %s')),
+           product=PRODUCT_ID, stock=PRODUCT_STOCK, returning=RETURNING)
+
+# The old quantity is part of the guard so the coupon adjustment stays exact if the line changed since it was read
+SET_SQL = """
+    UPDATE "CartItem" SET {values}
+    WHERE customer_id = %s AND product_id = {product} AND quantity = %s AND %s <= {stock}
+    {returning}
+""".format(values=LINE_VALUES.format(quantity='%s', discount=LINE_DISCOUNT.format(quantity='%s')),
+           product=PRODUCT_ID, stock=PRODUCT_STOCK, returning=RETURNING)
+
+REMOVE_SQL = """
+    DELETE FROM "CartItem" WHERE customer_id = %s AND product_id = {product} {returning}
+""".format(product=PRODUCT_ID, returning=RETURNING)
+
+# Decreases that would leave no units remove the line instead
+REMOVE_EMPTIED_SQL = """
+    DELETE FROM "CartItem" WHERE customer_id = %s AND product_id = {product} AND quantity + %s <= 0 {returning}
+""".format(product=PRODUCT_ID, returning=RETURNING)
+
+# Every product of the customer's wishlist in one upsert: one unit each, new lines take the cart coupon
+ADD_WISHLIST_SQL = """
+    INSERT INTO "CartItem" (customer_id, product_id, quantity, price, sub_total, discount, date_added,
+                            coupon_id, coupon_applied)
+    SELECT %s, p.id, 1, p.price, p.price - coalesce(c.discount, 0), coalesce(c.discount, 0), %s,
+           c.id, c.id IS NOT NULL
+    FROM "Product" p
+    LEFT JOIN "Coupon" c ON c.id = (SELECT coupon_id FROM "CartItem"
+                                    WHERE customer_id = %s AND coupon_applied LIMIT 1)
+    WHERE p.id IN (SELECT product_id FROM "Wishlist" WHERE customer_id = %s) AND p.stock >= 1
+    ON CONFLICT (customer_id, product_id) DO UPDATE SET {values}
+    WHERE "CartItem".quantity + excluded.quantity <= {stock}
+    RETURNING product_id, quantity, coupon_id, coupon_applied
+""".format(values=LINE_VALUES.format(quantity='"CartItem".quantity + excluded.quantity',
+                                     discount=LINE_DISCOUNT.format(quantity='"CartItem".quantity + excluded.quantity')),
+           stock=PRODUCT_STOCK)
+
+
+def execute(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+
+def execute_all(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+# The cart coupon reservation follows the quantity of the lines the coupon is applied to
+def adjust_coupon(customer, row, units):
+    quantity, coupon_id, coupon_applied = row
+    if not coupon_applied or coupon_id is None or not units:
+        return
+    if not coupons.adjust(customer, coupon_id, units):
+        # The coupon has no units left for the added quantity, the cart continues without it
+        coupons.clear_cart_coupon(customer)
+
+
+def rejected(customer, slug):
+    # Tell apart a line that is not in the cart from one the stock cannot cover
+    if CartItem.objects.filter(customer=customer, product__slug=slug).exists():
+        return OUT_OF_STOCK, None
+    return NOT_IN_CART, None
+
+
+# Add quantity units of the product to the cart, returns (status, new line quantity)
+def add_item(customer, slug, quantity=1):
+    row = execute(ADD_SQL, [customer.id, quantity, quantity, quantity, quantity, timezone.now(), customer.id,
+                            slug, quantity])
+    if row is None:
+        if Product.objects.filter(slug=slug).exists():
+            return OUT_OF_STOCK, None
+        return NOT_FOUND, None
+    adjust_coupon(customer, row, quantity)
+    if row[0] == quantity:
+        badges.adjust_badge(customer.user_id, badges.CART, 1)
+        return ADDED, row[0]
+    return UPDATED, row[0]
+
+
+# Change the line quantity by delta, the line is removed when it drops to zero
+def change_quantity(customer, slug, delta):
+    row = execute(CHANGE_SQL, [delta, delta, delta, delta, customer.id, slug, delta, delta, delta])
+    if row is not None:
+        adjust_coupon(customer, row, delta)
+        return UPDATED, row[0]
+    if delta < 0:
+        row = execute(REMOVE_EMPTIED_SQL, [customer.id, slug, delta])
+        if row is not None:
+            adjust_coupon(customer, row, -row[0])
+            badges.adjust_badge(customer.user_id, badges.CART, -1)
+            return REMOVED, 0
+        return NOT_IN_CART, None
+    return rejected(customer, slug)
+
+
+# Set the line quantity, zero removes the line
+def set_quantity(customer, slug, quantity):
+    if quantity == 0:
+        return remove_item(customer, slug)
+    line = CartItem.objects.filter(customer=customer, product__slug=slug).values_list('quantity', flat=True).first()
+    if line is None:
+        return NOT_IN_CART, None
+    row = execute(SET_SQL, [quantity, quantity, quantity, quantity, customer.id, slug, line, quantity])
+    if row is None:
+        return rejected(customer, slug)
+    adjust_coupon(customer, row, quantity - line)
+    return UPDATED, row[0]
+
+
+def remove_item(customer, slug):
+    row = execute(REMOVE_SQL, [customer.id, slug])
+    if row is None:
+        return NOT_IN_CART, None
+    adjust_coupon(customer, row, -row[0])
+    badges.adjust_badge(customer.user_id, badges.CART, -1)
+    return REMOVED, 0
+
+
+# Move the wishlist into the cart, products the stock cannot cover stay in the wishlist. Returns (moved, kept)
+@transaction.atomic
+def add_wishlist(customer):
+    rows = execute_all(ADD_WISHLIST_SQL, [customer.id, timezone.now(), customer.id, customer.id])
+    applied = [row for row in rows if row[3]]
+    if applied:
+        # One unit per line the coupon is applied to
+        adjust_coupon(customer, applied[0][1:], len(applied))
+    moved = [row[0] for row in rows]
+    Wishlist.objects.filter(customer=customer, product_id__in=moved).delete()
+    return len(moved), Wishlist.objects.filter(customer=customer).count()
+
+
+# Customers whose cart has not been added to since the cutoff
+def idle_carts(cutoff):
+    return CartItem.objects.values('customer_id').annotate(last_added=Max('date_added')).filter(
+        last_added__lt=cutoff).values_list('customer_id', flat=True)
+
+
+# Empty a batch of idle carts: their coupon units go back in aggregate, then their lines are deleted. Lines are
+# locked first, skipping those another request is changing; a cart with a skipped line or a line added since the
+# cutoff is left alone, and the DELETE only takes the locked lines. Returns (carts, lines, coupon units released).
+@transaction.atomic
+def sweep_carts(customer_ids, cutoff):
+    locked = list(CartItem.objects.select_for_update(skip_locked=True)
+                  .filter(customer_id__in=list(customer_ids), date_added__lt=cutoff).values_list('id', 'customer_id'))
+    busy = set(CartItem.objects.filter(customer_id__in=list(customer_ids))
+               .exclude(id__in=[line_id for line_id, _ in locked]).values_list('customer_id', flat=True))
+    lines = {line_id: customer_id for line_id, customer_id in locked if customer_id not in busy}
+    customer_ids = sorted(set(lines.values()))
+    if not customer_ids:
+        return 0, 0, 0
+    units = coupons.release_carts(customer_ids)
+    deleted = CartItem.objects.filter(id__in=list(lines), date_added__lt=cutoff).delete()[0]
+    user_ids = list(Customer.objects.filter(id__in=customer_ids).values_list('user_id', flat=True))
+    transaction.on_commit(lambda: badges.forget_badges(*user_ids))
+    return len(customer_ids), deleted, units
+
+
+# Every total the cart and checkout pages show, with the applied coupon code and discount, from one aggregate
+def cart_totals(customer):
+    applied = Q(coupon_applied=True, coupon__isnull=False)
+    totals = CartItem.objects.filter(customer=customer).aggregate(
+        total=Coalesce(Sum('sub_total'), ZERO),
+        total_amount_without_coupon=Coalesce(Sum(F('product__price') * F('quantity'), output_field=MONEY), ZERO),
+        line_discount=Coalesce(Sum('discount', filter=applied), ZERO),
+        discount=Coalesce(Sum(F('coupon__discount') * F('quantity'), filter=applied, output_field=MONEY), ZERO),
+        code=Max('coupon__code', filter=applied),
+        quantity=Coalesce(Sum('quantity'), 0),
+        count=Count('id'),
+    )
+    totals['total_amount_with_coupon'] = totals['total_amount_without_coupon'] - totals.pop('line_discount')
+    return totals
+
+
+# Cart lines with product and coupon joined, plus the cart totals
+def cart_summary(customer):
+    summary = cart_totals(customer)
+    summary['items'] = list(CartItem.objects.filter(customer=customer).select_related('product', 'coupon')
+                            .order_by('-date_added'))
+    return summary
+
+
+# One cart line as shown in the cart table, None when the product is not in the cart
+def cart_line(customer, slug):
+    return CartItem.objects.filter(customer=customer, product__slug=slug).values(
+        'quantity', 'price', 'sub_total', 'discount', slug=F('product__slug')).first()
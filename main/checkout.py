@@ -0,0 +1,116 @@
+import uuid
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from . import coupons, inventory
+from .leaderboards import update_leaderboards
+from .models import CartItem, Orders, OrderDetails, Payment, Product
+from .page_cache import bump_tags, product_tag
+from .transaction_ids import new_transaction_id
+
+# Checkout as one transaction: the cart is read once, every product is decremented by a guarded UPDATE that
+# also locks it and leaves the stock held for other customers alone, the order lines are inserted in one
+# statement and the cart is emptied. Any product short of stock rolls the whole order back.
+PENDING = 'Pending'
+CHECKOUT_TOKEN_LENGTH = 32
+# Transaction ids tried for one payment when the generated one is already taken
+TRANSACTION_ID_ATTEMPTS = 3
+
+
+class OutOfStock(Exception):
+    def __init__(self, product):
+        super().__init__('{} does not have enough stock'.format(product.name))
+        self.product = product
+
+
+def line_profit(line):
+    return (line.product.price - line.product.price_original) * line.quantity - line.discount
+
+
+# Stock goes to sold, as long as it is not held for other customers
+def take_stock(customer, line):
+    return inventory.take_stock(customer, line.product_id, line.quantity, sold=F('sold') + line.quantity,
+                                profit=F('profit') + line_profit(line))
+
+
+# Sold products move in the leaderboards and their cached pages are refreshed
+def products_sold(product_ids):
+    products = list(Product.objects.filter(id__in=product_ids))
+    bump_tags(*[product_tag(product.slug) for product in products])
+    update_leaderboards(products, ['sold', 'profit'])
+
+
+# Idempotency key rendered into the checkout form, stored on the order it places
+def new_checkout_token():
+    return uuid.uuid4().hex
+
+
+def clean_checkout_token(token):
+    return token if token and len(token) == CHECKOUT_TOKEN_LENGTH and token.isalnum() else None
+
+
+# The order already placed by this checkout form, if any
+def placed_order(customer, token):
+    if token is None:
+        return None
+    return Orders.objects.select_related('delivery_address').filter(customer=customer, idempotency_key=token).first()
+
+
+# Place an order for the customer's cart, returns the order and its lines, None when the cart is empty
+# Worker ids derived from the host name and process id can collide between processes, so can their ids.
+# Each insert runs in a savepoint and a taken id is retried with a new one; other constraint failures propagate.
+def create_payment(**fields):
+    for attempt in range(TRANSACTION_ID_ATTEMPTS):
+        transaction_id = new_transaction_id()
+        try:
+            with transaction.atomic():
+                return Payment.objects.create(transaction_id=transaction_id, **fields)
+        except IntegrityError:
+            if attempt == TRANSACTION_ID_ATTEMPTS - 1 or not Payment.objects.filter(
+                    transaction_id=transaction_id).exists():
+                raise
+
+
+@transaction.atomic
+def place_order(customer, delivery_address, payment_method, checkout_token=None):
+    # Cart lines are locked so a concurrent cart change waits for the order; products are locked by take_stock,
+    # always in product order so two checkouts cannot deadlock
+    lines = list(CartItem.objects.select_for_update(of=('self',)).filter(customer=customer)
+                 .select_related('product').order_by('product_id'))
+    if not lines:
+        return None, []
+    for line in lines:
+        if not take_stock(customer, line):
+            raise OutOfStock(line.product)
+
+    sub_total = sum(line.sub_total for line in lines)
+    total_discount = sum(line.discount for line in lines)
+    order = Orders.objects.create(
+        customer=customer,
+        status=PENDING,
+        sub_total=sub_total,
+        total_discount=total_discount,
+        total_amount=sub_total - total_discount,
+        profit_order=sum(line_profit(line) for line in lines),
+        delivery_address=delivery_address,
+        idempotency_key=checkout_token,
+    )
+    order_details = OrderDetails.objects.bulk_create([
+        OrderDetails(order=order, product=line.product, quantity=line.quantity, price=line.price,
+                     sub_total=line.sub_total, discount=line.discount, coupon_id=line.coupon_id,
+                     coupon_applied=line.coupon_applied)
+        for line in lines])
+    create_payment(
+        customer=customer,
+        order=order,
+        payment_method=payment_method,
+        payment_status=PENDING,
+        total=sub_total - total_discount,
+    )
+    # The coupon units reserved by the cart are now used by the order
+    coupons.redeem(customer, order)
+    inventory.convert_holds(customer)
+    CartItem.objects.filter(id__in=[line.id for line in lines]).delete()
+
+    product_ids = [line.product_id for line in lines]
+    transaction.on_commit(lambda: products_sold(product_ids))
+    return order, order_details
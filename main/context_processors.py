@@ -1,15 +1,23 @@
-from .models import Category, Brand, Product
+from django.utils.functional import SimpleLazyObject
+from .badges import get_badges
+from .cache import get_navigation
 
 
 def categories(request):
-    categories = Category.objects.all().order_by('id')
-    get_products = Product.objects.all().count()
-    return {'categories': categories,
-            'get_products': get_products}
+    navigation = get_navigation()
+    return {'categories': navigation['categories'],
+            'get_products': navigation['get_products']}
 
 
 def brands(request):
-    brands = Brand.objects.all().order_by('id')
-    get_products = Product.objects.all().count()
-    return {'brands': brands,
-            'get_products': get_products}
+    navigation = get_navigation()
+    return {'brands': navigation['brands'],
+            'get_products': navigation['get_products']}
+
+
+# Header cart and wishlist counts, read from the cache only when a template shows them
+def badges(request):
+    if not request.user.is_authenticated:
+        return {}
+    user_id = request.user.id
+    return {'badges': SimpleLazyObject(lambda: get_badges(user_id))}
@@ -0,0 +1,111 @@
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.db.models import F
+from .leaderboards import update_leaderboards
+from .models import Product
+
+# Write-behind product view counter. Views are counted in the cache and flushed to the database as one
+# UPDATE ... SET view_count = view_count + n per product, instead of saving the whole product row on every view.
+# The buffer is shared between workers only when the cache backend is shared (Redis, Memcached, database).
+# Requests only count; the flush_view_counts command writes the counts back, once or with --loop as a worker.
+VIEW_COUNT_KEY = 'product:views:{product_id}'
+# Products with buffered views are queued in numbered slots, so a flush reads only those products and two requests
+# marking different products never overwrite each other (the slot number comes from an atomic incr)
+DIRTY_SEQ_KEY = 'product:views:dirty'
+DIRTY_SLOT_KEY = 'product:views:dirty:{slot}'
+DIRTY_DONE_KEY = 'product:views:dirty:done'
+FLUSH_LOCK_KEY = 'product:views:flush'
+# A crashed flush releases the lock after this many seconds
+FLUSH_LOCK_TIMEOUT = 300
+
+
+def increment(key):
+    if cache.add(key, 1, timeout=None):
+        return 1
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The key expired or was evicted between add() and incr()
+        cache.add(key, 1, timeout=None)
+        return 1
+
+
+# Count one view of the product and return the number of views not yet flushed
+def record_view(product_id):
+    pending = increment(VIEW_COUNT_KEY.format(product_id=product_id))
+    # The first view since the last flush queues the product
+    if pending == 1:
+        mark_dirty(product_id)
+    return pending
+
+
+def mark_dirty(product_id):
+    cache.set(DIRTY_SLOT_KEY.format(slot=increment(DIRTY_SEQ_KEY)), product_id, timeout=None)
+
+
+def get_pending_views(product_ids):
+    keys = {VIEW_COUNT_KEY.format(product_id=product_id): product_id for product_id in product_ids}
+    return {keys[key]: count for key, count in cache.get_many(keys).items() if count}
+
+
+# Take the queued product ids out of the dirty slots
+def take_dirty_ids():
+    last = cache.get(DIRTY_SEQ_KEY, 0)
+    done = cache.get(DIRTY_DONE_KEY, 0)
+    if last <= done:
+        return set()
+    keys = [DIRTY_SLOT_KEY.format(slot=slot) for slot in range(done + 1, last + 1)]
+    product_ids = set(cache.get_many(keys).values())
+    cache.set(DIRTY_DONE_KEY, last, timeout=None)
+    cache.delete_many(keys)
+    return product_ids
+
+
+# Move buffered views into Product.view_count, returns the number of products and views written.
+# The queued products are flushed along with product_ids; all_products=True scans the whole catalog for views whose
+# slot was lost (cache eviction, a worker killed between the two cache writes of record_view).
+def flush_views(product_ids=None, all_products=False):
+    # Two flushes of the same counts would write them twice
+    if not cache.add(FLUSH_LOCK_KEY, 1, timeout=FLUSH_LOCK_TIMEOUT):
+        return 0, 0
+    try:
+        dirty_ids = take_dirty_ids()
+        if all_products:
+            product_ids = Product.objects.values_list('id', flat=True)
+        try:
+            return write_views(dirty_ids.union(product_ids or ()))
+        except DatabaseError:
+            # Queue the products again, their views are back in the buffer
+            for product_id in dirty_ids:
+                mark_dirty(product_id)
+            raise
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
+
+
+def write_views(product_ids):
+    pending = get_pending_views(product_ids)
+    products = views = 0
+    flushed = []
+    for product_id, count in pending.items():
+        key = VIEW_COUNT_KEY.format(product_id=product_id)
+        # Take the views out of the buffer first, views recorded meanwhile stay for the next flush
+        try:
+            remaining = cache.decr(key, count)
+        except ValueError:
+            continue
+        # Views recorded since get_pending_views() did not queue the product, their count was above zero
+        if remaining > 0:
+            mark_dirty(product_id)
+        try:
+            with transaction.atomic():
+                Product.objects.filter(id=product_id).update(view_count=F('view_count') + count)
+        except DatabaseError:
+            cache.incr(key, count)
+            raise
+        products += 1
+        views += count
+        flushed.append(product_id)
+    if flushed:
+        update_leaderboards(Product.objects.filter(id__in=flushed), fields=['view_count'])
+    return products, views
@@ -0,0 +1,162 @@
+from decimal import Decimal
+from urllib.parse import quote
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.utils import timezone
+from .cache import bump_version, get_version
+from .models import CartItem, Coupon, CouponRedemption, Product
+
+# Coupon units are taken from Coupon.amount with a single guarded UPDATE, so concurrent redemptions can never
+# overdraw it. The units a cart holds are recorded as its reservation (a CouponRedemption without order), which
+# grows and shrinks with the cart and is attached to the order at checkout.
+RESERVED = 'Reserved'
+REDEEMED = 'Redeemed'
+
+# Coupon metadata (discount, validity window) cached by code, bumped on every coupon save or delete. The amount
+# is never cached: units are only ever taken from the database row, with the guarded UPDATE below.
+COUPON_VERSION_KEY = 'coupon:version'
+COUPON_KEY = 'coupon:{code}:{version}'
+COUPON_TIMEOUT = 60 * 5
+COUPON_FIELDS = ('id', 'code', 'discount', 'valid_from', 'valid_to', 'is_active')
+MISSING = 'missing'
+
+
+def bump_coupon_version():
+    bump_version(COUPON_VERSION_KEY)
+
+
+def get_coupon_meta(code):
+    key = COUPON_KEY.format(code=quote(code, safe=''), version=get_version(COUPON_VERSION_KEY))
+    meta = cache.get(key)
+    if meta is None:
+        # Unknown codes are cached too, so guessing codes does not reach the database
+        meta = Coupon.objects.filter(code=code).values(*COUPON_FIELDS).first() or MISSING
+        cache.set(key, meta, timeout=COUPON_TIMEOUT)
+    return None if meta == MISSING else meta
+
+
+# The active coupon with this code valid right now, or None. Only its metadata is loaded, not the amount left.
+def get_valid_coupon(code):
+    code = (code or '').strip()
+    if not code or len(code) > Coupon._meta.get_field('code').max_length:
+        return None
+    meta = get_coupon_meta(code)
+    now = timezone.now()
+    if meta is None or not meta['is_active'] or meta['valid_from'] is None or meta['valid_to'] is None \
+            or not meta['valid_from'] <= now <= meta['valid_to']:
+        return None
+    return Coupon(**meta)
+
+
+# UPDATE "Coupon" SET amount = amount - n WHERE id = ... AND amount >= n
+def take_units(coupon_id, units):
+    return Coupon.objects.filter(id=coupon_id, amount__gte=units).update(amount=F('amount') - units) == 1
+
+
+def return_units(coupon_id, units):
+    if units:
+        Coupon.objects.filter(id=coupon_id).update(amount=F('amount') + units)
+
+
+# Reserve units of the coupon for the customer's cart, False when the coupon does not have them left
+@transaction.atomic
+def reserve(customer, coupon_id, units):
+    if units <= 0:
+        return True
+    if not take_units(coupon_id, units):
+        return False
+    if CouponRedemption.objects.filter(customer=customer, order=None, coupon_id=coupon_id).update(
+            quantity=F('quantity') + units):
+        return True
+    try:
+        with transaction.atomic():
+            CouponRedemption.objects.create(customer=customer, coupon_id=coupon_id, quantity=units, status=RESERVED)
+    except IntegrityError:
+        # Another request created the reservation first, or the cart holds another coupon
+        if not CouponRedemption.objects.filter(customer=customer, order=None, coupon_id=coupon_id).update(
+                quantity=F('quantity') + units):
+            return_units(coupon_id, units)
+            return False
+    return True
+
+
+# Give units (all of them by default) of the cart reservation back to the coupon, returns the units released
+@transaction.atomic
+def release(customer, units=None):
+    redemption = CouponRedemption.objects.select_for_update().filter(customer=customer, order=None).first()
+    if redemption is None:
+        return 0
+    if units is None or units >= redemption.quantity:
+        units = redemption.quantity
+        redemption.delete()
+    else:
+        CouponRedemption.objects.filter(id=redemption.id).update(quantity=F('quantity') - units)
+    return_units(redemption.coupon_id, units)
+    return units
+
+
+# Follow a change of delta units on cart lines that have the coupon applied
+def adjust(customer, coupon_id, delta):
+    if delta > 0:
+        return reserve(customer, coupon_id, delta)
+    if delta < 0:
+        release(customer, -delta)
+    return True
+
+
+# Give the cart reservations of many customers back to their coupons in one UPDATE, returns the units released
+@transaction.atomic
+def release_carts(customer_ids):
+    reservations = CouponRedemption.objects.filter(customer_id__in=customer_ids, order=None)
+    released = reservations.aggregate(units=Sum('quantity'))['units']
+    if not released:
+        return 0
+    units = reservations.filter(coupon=OuterRef('pk')).values('coupon').annotate(units=Sum('quantity')).values('units')
+    Coupon.objects.filter(id__in=reservations.values('coupon_id')).update(amount=F('amount') + Subquery(units))
+    reservations.delete()
+    return released
+
+
+def money(expression):
+    return ExpressionWrapper(expression, output_field=DecimalField(max_digits=10, decimal_places=1))
+
+
+# Reprice every line of the cart at the current product price in one UPDATE, with the coupon discount or none
+def reprice_cart(customer, coupon=None):
+    price = Subquery(Product.objects.filter(id=OuterRef('product_id')).values('price')[:1])
+    discount = money(Value(coupon.discount) * F('quantity')) if coupon is not None else Value(Decimal(0))
+    return CartItem.objects.filter(customer=customer).update(
+        coupon=coupon, coupon_applied=coupon is not None, price=price, discount=discount,
+        sub_total=money(price * F('quantity') - discount))
+
+
+# Apply the coupon to the whole cart: reserve one unit per item, then reprice the lines
+@transaction.atomic
+def apply_cart_coupon(customer, coupon, units):
+    release(customer)
+    if not reserve(customer, coupon.id, units):
+        return False
+    reprice_cart(customer, coupon)
+    return True
+
+
+# Take the coupon off every line of the cart and release its units
+@transaction.atomic
+def clear_cart_coupon(customer):
+    released = release(customer)
+    reprice_cart(customer)
+    return released
+
+
+# Attach the cart reservation to the order placed from the cart
+def redeem(customer, order):
+    return CouponRedemption.objects.filter(customer=customer, order=None).update(order=order, status=REDEEMED)
+
+
+# Give the units an order used back to their coupons, for orders that are cancelled or deleted
+@transaction.atomic
+def release_order(order):
+    for redemption in CouponRedemption.objects.select_for_update().filter(order=order):
+        return_units(redemption.coupon_id, redemption.quantity)
+        redemption.delete()
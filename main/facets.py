@@ -0,0 +1,171 @@
+import hashlib
+from decimal import Decimal, InvalidOperation
+from django.core.cache import cache
+from django.db.models import Count, Q
+from . import search
+from .cache import get_catalog_version, get_navigation
+from .models import Product
+
+# Storefront facets: how many products each brand, category and price range would return for the current search
+PRICE_BUCKETS = 5
+FACETS_KEY = 'catalog:facets:{version}:{filters}'
+PRICE_BUCKETS_KEY = 'catalog:price_buckets:{version}'
+FACETS_TIMEOUT = 60 * 15
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_decimal(value):
+    try:
+        return Decimal(value)
+    except (TypeError, ValueError, InvalidOperation):
+        return None
+
+
+# Price ranges are (low, high, high included). Bucket keys look like under_140, 140-500 or from_2000 and include
+# the lower bound only, so buckets partition the catalog. The legacy less_100, 100_500 ... greater_2000 keys
+# posted by the home page and dashboard forms keep their old meaning and include both bounds.
+def parse_price(key):
+    if not key:
+        return None
+    if '-' in key:
+        low, _, high = key.partition('-')
+        low, high = to_decimal(low), to_decimal(high)
+        return (low, high, False) if low is not None and high is not None else None
+    low, _, high = key.partition('_')
+    if low in ('under', 'less'):
+        high = to_decimal(high)
+        return (None, high, low == 'less') if high is not None else None
+    if low in ('from', 'greater'):
+        low = to_decimal(high)
+        return (low, None, False) if low is not None else None
+    low, high = to_decimal(low), to_decimal(high)
+    return (low, high, True) if low is not None and high is not None else None
+
+
+def price_q(price_range):
+    if price_range is None:
+        return Q()
+    low, high, high_included = price_range
+    q = Q()
+    if low is not None:
+        q &= Q(price__gte=low)
+    if high is not None:
+        q &= Q(price__lte=high) if high_included else Q(price__lt=high)
+    return q
+
+
+def normalize_filters(search_query=None, brand=None, category=None, price=None):
+    return {
+        'search': (search_query or '').strip(),
+        'brand': to_int(brand),
+        'category': to_int(category),
+        'price': parse_price(price),
+    }
+
+
+def filters_key(filters):
+    # Word order and case do not change full text matches, so 'S23 galaxy' and 'galaxy s23' share an entry
+    normalized = dict(filters)
+    if search.is_supported() and search.tokenize(filters['search']):
+        normalized['search'] = ' '.join(sorted(set(search.tokenize(filters['search']))))
+    return hashlib.md5(repr(sorted(normalized.items())).encode('utf-8')).hexdigest()
+
+
+# Q for the normalized filters; exclude leaves one facet out so its own counts are not narrowed by itself
+def filter_q(filters, exclude=None):
+    q = Q()
+    if filters['brand'] is not None and exclude != 'brand':
+        q &= Q(brand_id=filters['brand'])
+    if filters['category'] is not None and exclude != 'category':
+        q &= Q(category_id=filters['category'])
+    if exclude != 'price':
+        q &= price_q(filters['price'])
+    return q
+
+
+def format_price(value):
+    return '${}'.format(value.quantize(Decimal(1)) if value == value.to_integral_value() else value)
+
+
+# Round a price boundary to two significant digits so buckets read naturally (137 -> 140, 1234 -> 1200)
+def round_price(value):
+    value = int(value)
+    if value <= 0:
+        return 0
+    magnitude = 10 ** max(len(str(value)) - 2, 0)
+    return int(round(value / magnitude)) * magnitude
+
+
+def build_price_buckets():
+    prices = list(Product.objects.exclude(price=None).order_by('price').values_list('price', flat=True))
+    if not prices:
+        return []
+    # Boundaries at the price quantiles, so each bucket holds a similar share of the catalog
+    boundaries = sorted({round_price(prices[len(prices) * i // PRICE_BUCKETS]) for i in range(1, PRICE_BUCKETS)})
+    boundaries = [Decimal(boundary) for boundary in boundaries if prices[0] < boundary <= prices[-1]]
+    if not boundaries:
+        return []
+    buckets = [{'key': 'under_{}'.format(boundaries[0]), 'label': 'Less than {}'.format(format_price(boundaries[0])),
+                'range': (None, boundaries[0], False)}]
+    for low, high in zip(boundaries, boundaries[1:]):
+        buckets.append({'key': '{}-{}'.format(low, high),
+                        'label': '{} - {}'.format(format_price(low), format_price(high)),
+                        'range': (low, high, False)})
+    buckets.append({'key': 'from_{}'.format(boundaries[-1]),
+                    'label': '{} and above'.format(format_price(boundaries[-1])),
+                    'range': (boundaries[-1], None, False)})
+    return buckets
+
+
+def get_price_buckets():
+    key = PRICE_BUCKETS_KEY.format(version=get_catalog_version())
+    buckets = cache.get(key)
+    if buckets is None:
+        buckets = build_price_buckets()
+        cache.set(key, buckets, timeout=FACETS_TIMEOUT)
+    return buckets
+
+
+def build_facets(filters):
+    navigation = get_navigation()
+    buckets = get_price_buckets()
+    products = Product.objects.all()
+    if filters['search']:
+        products = search.filter_products(products, filters['search'])
+    # Every facet value is a conditional count in one aggregate query; each facet ignores its own filter
+    brand_filter = filter_q(filters, exclude='brand')
+    category_filter = filter_q(filters, exclude='category')
+    price_filter = filter_q(filters, exclude='price')
+    aggregates = {}
+    for brand in navigation['brands']:
+        aggregates['brand_{}'.format(brand['id'])] = Count('id', filter=Q(brand_id=brand['id']) & brand_filter)
+    for category in navigation['categories']:
+        aggregates['category_{}'.format(category['id'])] = Count(
+            'id', filter=Q(category_id=category['id']) & category_filter)
+    for index, bucket in enumerate(buckets):
+        aggregates['price_{}'.format(index)] = Count('id', filter=price_q(bucket['range']) & price_filter)
+    counts = products.aggregate(**aggregates) if aggregates else {}
+    return {
+        'brands': [dict(brand, product_count=counts['brand_{}'.format(brand['id'])])
+                   for brand in navigation['brands']],
+        'categories': [dict(category, product_count=counts['category_{}'.format(category['id'])])
+                       for category in navigation['categories']],
+        'prices': [{'key': bucket['key'], 'label': bucket['label'], 'product_count': counts['price_{}'.format(index)]}
+                   for index, bucket in enumerate(buckets)],
+    }
+
+
+# Facet counts for the normalized filters, cached per catalog version and filter set
+def get_facets(filters):
+    key = FACETS_KEY.format(version=get_catalog_version(), filters=filters_key(filters))
+    facets = cache.get(key)
+    if facets is None:
+        facets = build_facets(filters)
+        cache.set(key, facets, timeout=FACETS_TIMEOUT)
+    return facets
@@ -0,0 +1,49 @@
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import CartItem, InventoryHold, Product
+
+# Stock held for the cart of a customer who entered checkout. Available stock is the product stock minus the
+# active holds of other customers; holds are checked while their products are locked, become sales when the
+# order is placed (the stock UPDATE of checkout honours the other holds) and simply stop counting once expired.
+# The stock row is only written when the order is placed.
+HOLD_TTL = 60 * 15
+
+
+def held_by_others(customer, now=None):
+    # Quantity of the product (OuterRef) held by the other customers, for use in a product query
+    holds = InventoryHold.objects.filter(product=OuterRef('pk'), expires_at__gt=now or timezone.now()) \
+        .exclude(customer=customer).values('product').annotate(quantity=Sum('quantity')).values('quantity')
+    return Coalesce(Subquery(holds), 0)
+
+
+# Hold the stock of every cart line for HOLD_TTL, returns the cart products the available stock cannot cover
+@transaction.atomic
+def hold_cart(customer):
+    now = timezone.now()
+    lines = dict(CartItem.objects.filter(customer=customer).values_list('product_id', 'quantity'))
+    products = list(Product.objects.select_for_update().filter(id__in=list(lines)).order_by('id')
+                    .annotate(held=held_by_others(customer, now)))
+    short = [product for product in products if product.stock - product.held < lines[product.id]]
+    if short:
+        return short
+    InventoryHold.objects.filter(product_id__in=list(lines), expires_at__lte=now).delete()
+    InventoryHold.objects.filter(customer=customer).delete()
+    InventoryHold.objects.bulk_create([
+        InventoryHold(product_id=product_id, customer=customer, quantity=quantity,
+                      expires_at=now + timedelta(seconds=HOLD_TTL))
+        for product_id, quantity in lines.items()])
+    return []
+
+
+# UPDATE "Product" SET stock = stock - n, ... WHERE id = ... AND stock - <held by others> >= n
+def take_stock(customer, product_id, quantity, **counters):
+    return Product.objects.filter(id=product_id, stock__gte=held_by_others(customer) + quantity).update(
+        stock=F('stock') - quantity, **counters) == 1
+
+
+# The customer's holds became an order
+def convert_holds(customer):
+    InventoryHold.objects.filter(customer=customer).delete()
@@ -0,0 +1,73 @@
+from django.core.cache import cache
+from django.db.models import F
+from .cache import get_catalog_version
+from .models import Product
+
+# Top products by counter, kept in the cache and updated in place when counters change instead of sorting the
+# product table on every page. Each board keeps twice the displayed size, so a product falling out of the top
+# can be dropped without a query; it is rebuilt when it runs short or when the catalog version changes.
+# A board cut off at LEADERBOARD_DEPTH remembers the rank of its last entry when it was built (its floor): every
+# product ranked at or above the floor is known, below it products the board never loaded may rank higher.
+LEADERBOARD_FIELDS = ('sold', 'view_count', 'profit', 'review_rate_average')
+LEADERBOARD_SIZE = 10
+LEADERBOARD_DEPTH = LEADERBOARD_SIZE * 2
+LEADERBOARD_KEY = 'catalog:leaderboard:{field}:{version}'
+# Safety net for updates lost to concurrent writers
+LEADERBOARD_TIMEOUT = 60 * 15
+
+
+def leaderboard_key(field):
+    return LEADERBOARD_KEY.format(field=field, version=get_catalog_version())
+
+
+def rank(product, field):
+    return getattr(product, field) or 0, product.id
+
+
+def build_leaderboard(field):
+    products = list(Product.objects.order_by(F(field).desc(nulls_last=True), '-id')[:LEADERBOARD_DEPTH])
+    floor = rank(products[-1], field) if len(products) >= LEADERBOARD_DEPTH else None
+    return {'products': products, 'floor': floor}
+
+
+# Merge products with new counter values into a board, returns None when the board must be rebuilt
+def merge_leaderboard(board, products, field):
+    changed = {product.id: product for product in products}
+    floor = board['floor']
+    # Products now ranked below the floor may be outranked by products the board does not know about
+    entries = [product for product in board['products'] if product.id not in changed]
+    entries.extend(product for product in changed.values() if floor is None or rank(product, field) >= floor)
+    entries.sort(key=lambda product: rank(product, field), reverse=True)
+    if len(entries) > LEADERBOARD_DEPTH:
+        entries = entries[:LEADERBOARD_DEPTH]
+        floor = rank(entries[-1], field)
+    if floor is not None and len(entries) < LEADERBOARD_SIZE:
+        return None
+    return {'products': entries, 'floor': floor}
+
+
+# Top products by field, one cache read once the board is built
+def get_leaderboard(field, size=4):
+    key = leaderboard_key(field)
+    board = cache.get(key)
+    if board is None:
+        board = build_leaderboard(field)
+        cache.set(key, board, timeout=LEADERBOARD_TIMEOUT)
+    return board['products'][:size]
+
+
+def update_leaderboards(products, fields=LEADERBOARD_FIELDS):
+    products = list(products)
+    if not products:
+        return
+    for field in fields:
+        key = leaderboard_key(field)
+        board = cache.get(key)
+        # Boards not built yet are built from the database on the next read
+        if board is None:
+            continue
+        board = merge_leaderboard(board, products, field)
+        if board is None:
+            cache.delete(key)
+        else:
+            cache.set(key, board, timeout=LEADERBOARD_TIMEOUT)
@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand
+from main.counters import flush_views
+
+
+# Write buffered product views to the database. Run from a scheduler, or with --loop as a worker process.
+class Command(BaseCommand):
+    help = 'Flush buffered product view counts to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Check every product, not only the ones queued by record_view')
+        parser.add_argument('--loop', action='store_true', help='Keep flushing every --interval seconds')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between two flushes')
+
+    def handle(self, *args, **options):
+        while True:
+            products, views = flush_views(all_products=options['all'])
+            if views or not options['loop']:
+                self.stdout.write('Flushed {} views for {} products'.format(views, products))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS('View counts flushed'))
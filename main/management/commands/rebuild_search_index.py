@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from main import search
+from main.models import Product
+
+
+# Rebuild the product full text search index from scratch
+class Command(BaseCommand):
+    help = 'Rebuild the product full text search index'
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            self.stdout.write(self.style.WARNING('Full text search is not available on this database, '
+                                                 'product search uses icontains'))
+            return
+        search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS('Indexed {} products'.format(Product.objects.count())))
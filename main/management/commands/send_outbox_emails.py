@@ -0,0 +1,32 @@
+import time
+from django.core.management.base import BaseCommand
+from main import outbox
+
+
+# Send the emails queued by the views. Run once from a scheduler, or with --loop as a worker process.
+class Command(BaseCommand):
+    help = 'Send pending emails from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=outbox.BATCH_SIZE,
+                            help='Emails sent over one connection')
+        parser.add_argument('--backend', default=None,
+                            help='Email backend to send with, e.g. django.core.mail.backends.console.EmailBackend '
+                                 '(defaults to EMAIL_BACKEND)')
+        parser.add_argument('--loop', action='store_true', help='Keep sending, waiting for new emails')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait when the outbox is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            sent, failed = outbox.send_batch(options['batch_size'], options['backend'])
+            if sent or failed:
+                self.stdout.write('Sent {} emails, {} failed in {:.2f}s'.format(sent, failed,
+                                                                               time.monotonic() - started))
+                # A full batch probably means more are due, send them right away
+                if sent + failed == options['batch_size']:
+                    continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS('Outbox drained'))
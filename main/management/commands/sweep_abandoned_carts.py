@@ -0,0 +1,32 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from main import cart
+
+
+# Empty carts nobody has added to for a while, giving their reserved coupon units back. Meant to run on a schedule.
+class Command(BaseCommand):
+    help = 'Delete carts idle for longer than the TTL and release their coupon reservations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Carts idle for more days than this are swept')
+        parser.add_argument('--batch-size', type=int, default=500, help='Carts swept per transaction')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        customer_ids = list(cart.idle_carts(cutoff))
+        self.stdout.write('Found {} idle carts in {:.2f}s'.format(len(customer_ids), time.monotonic() - started))
+
+        carts = lines = units = 0
+        for start in range(0, len(customer_ids), batch_size):
+            batch_started = time.monotonic()
+            swept = cart.sweep_carts(customer_ids[start:start + batch_size], cutoff)
+            carts, lines, units = carts + swept[0], lines + swept[1], units + swept[2]
+            self.stdout.write('Batch {}: {} carts, {} lines, {} coupon units in {:.2f}s'.format(
+                start // batch_size + 1, swept[0], swept[1], swept[2], time.monotonic() - batch_started))
+
+        self.stdout.write(self.style.SUCCESS('Swept {} carts ({} lines), released {} coupon units in {:.2f}s'.format(
+            carts, lines, units, time.monotonic() - started)))
@@ -0,0 +1,53 @@
+# Full text search document for products, PostgreSQL tsvector + GIN index or SQLite FTS5 table
+
+from django.db import migrations
+
+
+def create_search_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE "ProductSearch" ('
+            'product_id bigint PRIMARY KEY REFERENCES "Product" (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+            'document tsvector NOT NULL)'
+        )
+        schema_editor.execute('CREATE INDEX "ProductSearch_document_gin" ON "ProductSearch" USING GIN (document)')
+        schema_editor.execute(
+            'INSERT INTO "ProductSearch" (product_id, document) SELECT p.id, '
+            "setweight(to_tsvector('simple', coalesce(p.name, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(c.name, '')), 'B') || "
+            "setweight(to_tsvector('simple', coalesce(b.name, '')), 'B') || "
+            "setweight(to_tsvector('simple', replace(coalesce(p.slug, ''), '-', ' ')), 'C') "
+            'FROM "Product" p LEFT JOIN "Category" c ON c.id = p.category_id LEFT JOIN "Brand" b ON b.id = p.brand_id'
+        )
+    elif connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                # No FTS5 in this SQLite build, product search falls back to icontains
+                return
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE "ProductSearch" USING fts5(name, category, brand, slug, tokenize = \'unicode61\')'
+        )
+        schema_editor.execute(
+            'INSERT INTO "ProductSearch" (rowid, name, category, brand, slug) '
+            "SELECT p.id, coalesce(p.name, ''), coalesce(c.name, ''), coalesce(b.name, ''), "
+            "replace(coalesce(p.slug, ''), '-', ' ') "
+            'FROM "Product" p LEFT JOIN "Category" c ON c.id = p.category_id LEFT JOIN "Brand" b ON b.id = p.brand_id'
+        )
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute('DROP TABLE IF EXISTS "ProductSearch"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_alter_customer_customer_image'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
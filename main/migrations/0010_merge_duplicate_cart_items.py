@@ -0,0 +1,29 @@
+from django.db import migrations
+from django.db.models import Min, Sum, Count
+
+
+# Merge duplicate cart lines into the oldest one before the constraint is added
+def merge_cart_items(apps, schema_editor):
+    CartItem = apps.get_model('main', 'CartItem')
+    duplicates = (CartItem.objects.values('customer_id', 'product_id').annotate(lines=Count('id'), first=Min('id'),
+                                                                             quantity=Sum('quantity'),
+                                                                             sub_total=Sum('sub_total'),
+                                                                             discount=Sum('discount'))
+                  .filter(lines__gt=1))
+    for duplicate in duplicates:
+        CartItem.objects.filter(id=duplicate['first']).update(quantity=duplicate['quantity'],
+                                                              sub_total=duplicate['sub_total'],
+                                                              discount=duplicate['discount'])
+        CartItem.objects.filter(customer_id=duplicate['customer_id'], product_id=duplicate['product_id']) \
+            .exclude(id=duplicate['first']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_product_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_cart_items, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.3 on 2026-10-18 04:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_cartitem_unique_cart_item'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('Reserved', 'Reserved'), ('Redeemed', 'Redeemed')], default='Reserved', max_length=50)),
+                ('date_added', models.DateTimeField(auto_now_add=True, null=True)),
+                ('date_updated', models.DateTimeField(auto_now=True, null=True)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.coupon')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.customer')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='main.orders')),
+            ],
+            options={
+                'db_table': 'CouponRedemption',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='couponredemption',
+            constraint=models.UniqueConstraint(condition=models.Q(('order__isnull', True)), fields=('customer',), name='unique_cart_coupon_redemption'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations
+from django.db.models import Sum
+
+
+# Carts that already have a coupon applied hold its units: record them as reservations
+def reserve_applied_coupons(apps, schema_editor):
+    CartItem = apps.get_model('main', 'CartItem')
+    CouponRedemption = apps.get_model('main', 'CouponRedemption')
+    reserved = set()
+    lines = (CartItem.objects.filter(coupon_applied=True, coupon__isnull=False, customer__isnull=False)
+             .values('customer_id', 'coupon_id').annotate(quantity=Sum('quantity')).order_by('customer_id'))
+    for line in lines:
+        if line['customer_id'] in reserved:
+            continue
+        reserved.add(line['customer_id'])
+        CouponRedemption.objects.create(customer_id=line['customer_id'], coupon_id=line['coupon_id'],
+                                        quantity=line['quantity'], status='Reserved')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_coupon_redemption'),
+    ]
+
+    operations = [
+        migrations.RunPython(reserve_applied_coupons, migrations.RunPython.noop),
+    ]
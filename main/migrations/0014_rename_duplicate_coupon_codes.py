@@ -0,0 +1,36 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def unique_code(code, suffix, taken):
+    # Suffixes are tried until the renamed code is free, a code cut to fit the column could clash otherwise
+    attempt = 0
+    while True:
+        candidate = code[:20 - len(suffix)] + suffix
+        if candidate not in taken:
+            return candidate
+        attempt += 1
+        suffix = '-{}'.format(attempt) + suffix
+
+
+# Keep the oldest coupon of every duplicated code, the others get their id appended before the code becomes unique
+def rename_duplicate_coupons(apps, schema_editor):
+    Coupon = apps.get_model('main', 'Coupon')
+    duplicates = Coupon.objects.values('code').annotate(coupons=Count('id'), first=Min('id')).filter(coupons__gt=1)
+    taken = set(Coupon.objects.values_list('code', flat=True))
+    for duplicate in duplicates:
+        for coupon in Coupon.objects.filter(code=duplicate['code']).exclude(id=duplicate['first']):
+            code = unique_code(coupon.code, '-{}'.format(coupon.id), taken)
+            taken.add(code)
+            Coupon.objects.filter(id=coupon.id).update(code=code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_reserve_applied_coupons'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_coupons, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 05:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_rename_duplicate_coupon_codes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=20, unique=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.3 on 2026-10-18 05:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_outbox_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField()),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.customer')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.product')),
+            ],
+            options={
+                'db_table': 'InventoryHold',
+                'indexes': [models.Index(fields=['product', 'expires_at'], name='inventory_hold_active')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='inventoryhold',
+            constraint=models.UniqueConstraint(fields=('customer', 'product'), name='unique_inventory_hold'),
+        ),
+    ]
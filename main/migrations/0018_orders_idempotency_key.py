@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 05:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_inventory_hold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orders',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
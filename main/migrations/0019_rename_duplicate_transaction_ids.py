@@ -0,0 +1,23 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+# Keep the first payment of every duplicated transaction id, the others get their id appended
+def rename_duplicate_transaction_ids(apps, schema_editor):
+    Payment = apps.get_model('main', 'Payment')
+    duplicates = (Payment.objects.exclude(transaction_id=None).values('transaction_id')
+                  .annotate(payments=Count('id'), first=Min('id')).filter(payments__gt=1))
+    for duplicate in duplicates:
+        for payment in Payment.objects.filter(transaction_id=duplicate['transaction_id']).exclude(id=duplicate['first']):
+            Payment.objects.filter(id=payment.id).update(transaction_id='{}-{}'.format(payment.transaction_id, payment.id))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_orders_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_transaction_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 05:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_rename_duplicate_transaction_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='transaction_id',
+            field=models.CharField(max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Count, Q
 from django.contrib.auth.models import User
 from cloudinary.models import CloudinaryField
 
@@ -34,14 +35,18 @@ class Customer(models.Model):
         db_table = "Customer"
 
 
+# Category and brand querysets, annotate product counts in one GROUP BY instead of one COUNT per row
+class ProductCountQuerySet(models.QuerySet):
+    def with_product_count(self):
+        return self.annotate(product_count=Count('product'))
+
+
 class Category(models.Model):
     slug = models.SlugField(max_length=50, unique=True, null=True, blank=True)
     name = models.CharField(max_length=40)
     description = models.TextField(null=True, blank=True)
 
-    @property
-    def get_products_count(self):
-        return self.product_set.count() or 0
+    objects = ProductCountQuerySet.as_manager()
 
     def __str__(self):
         return self.name
@@ -56,9 +61,7 @@ class Brand(models.Model):
     description = models.TextField(null=True, blank=True)
     logo = CloudinaryField('brand_logo', null=True, blank=True, default='logo/default_logo.png')
 
-    @property
-    def get_products_count(self):
-        return self.product_set.count() or 0
+    objects = ProductCountQuerySet.as_manager()
 
     def __str__(self):
         return self.name
@@ -94,7 +97,7 @@ class Product(models.Model):
 
 
 class Coupon(models.Model):
-    code = models.CharField(max_length=20)
+    code = models.CharField(max_length=20, unique=True)
     discount = models.DecimalField(max_digits=10, decimal_places=1, null=True, blank=True)
     amount = models.PositiveIntegerField(default=1)
     valid_from = models.DateTimeField(blank=True, null=True)
@@ -108,6 +111,32 @@ class Coupon(models.Model):
         db_table = "Coupon"
 
 
+# Coupon units held by a customer's cart (order is empty) or used by an order
+class CouponRedemption(models.Model):
+    STATUS = (
+        ('Reserved', 'Reserved'),
+        ('Redeemed', 'Redeemed'),
+    )
+    coupon = models.ForeignKey('Coupon', on_delete=models.CASCADE)
+    customer = models.ForeignKey('Customer', on_delete=models.CASCADE)
+    order = models.ForeignKey('Orders', on_delete=models.CASCADE, null=True, blank=True)
+    quantity = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=50, choices=STATUS, default='Reserved')
+    date_added = models.DateTimeField(auto_now_add=True, null=True)
+    date_updated = models.DateTimeField(auto_now=True, null=True)
+
+    def __str__(self):
+        return self.coupon.code
+
+    class Meta:
+        db_table = "CouponRedemption"
+        # A cart holds at most one coupon reservation
+        constraints = [
+            models.UniqueConstraint(fields=['customer'], condition=Q(order__isnull=True),
+                                    name='unique_cart_coupon_redemption'),
+        ]
+
+
 class CartItem(models.Model):
     customer = models.ForeignKey('Customer', on_delete=models.CASCADE, null=True)
     product = models.ForeignKey('Product', on_delete=models.CASCADE, null=True)
@@ -151,6 +180,10 @@ class CartItem(models.Model):
 
     class Meta:
         db_table = "CartItem"
+        # One line per product in a cart, concurrent adds upsert into it
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'product'], name='unique_cart_item'),
+        ]
 
 
 class Orders(models.Model):
@@ -168,6 +201,8 @@ class Orders(models.Model):
     total_amount = models.DecimalField(max_digits=10, decimal_places=1, null=True, blank=True)
     profit_order = models.DecimalField(max_digits=10, decimal_places=1, null=True, blank=True)
     delivery_address = models.ForeignKey('DeliveryAddress', on_delete=models.CASCADE, null=True)
+    # Token of the checkout form that placed the order, a repeated submit returns this order
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, unique=True)
 
     def __str__(self):
         return self.id.__str__()
@@ -254,7 +289,7 @@ class Payment(models.Model):
     payment_method = models.CharField(max_length=50, null=True, choices=METHOD_CHOICES)
     payment_status = models.CharField(max_length=50, null=True, choices=PAYMENT_STATUS_CHOICES)
     total = models.DecimalField(max_digits=10, decimal_places=1, null=True)
-    transaction_id = models.CharField(max_length=100, null=True)
+    transaction_id = models.CharField(max_length=100, null=True, unique=True)
     payment_date = models.DateTimeField(auto_now_add=True, null=True)
 
     def __str__(self):
@@ -306,3 +341,53 @@ class Feedback(models.Model):
 
     class Meta:
         db_table = "Feedback"
+
+
+# Stock held for a customer between entering checkout and placing the order, ignored once expired
+class InventoryHold(models.Model):
+    product = models.ForeignKey('Product', on_delete=models.CASCADE)
+    customer = models.ForeignKey('Customer', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    date_added = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{} x {}'.format(self.product_id, self.quantity)
+
+    class Meta:
+        db_table = "InventoryHold"
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'product'], name='unique_inventory_hold'),
+        ]
+        indexes = [
+            models.Index(fields=['product', 'expires_at'], name='inventory_hold_active'),
+        ]
+
+
+# Rendered emails waiting to be sent by the send_outbox_emails command
+class OutboxEmail(models.Model):
+    STATUS = (
+        ('Pending', 'Pending'),
+        ('Sent', 'Sent'),
+        ('Failed', 'Failed'),
+    )
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to = models.JSONField(default=list)
+    content_subtype = models.CharField(max_length=20, default='html')
+    status = models.CharField(max_length=20, choices=STATUS, default='Pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(auto_now_add=True)
+    last_error = models.TextField(blank=True, default='')
+    date_added = models.DateTimeField(auto_now_add=True)
+    date_sent = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        db_table = "OutboxEmail"
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='outbox_email_due'),
+        ]
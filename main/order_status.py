@@ -0,0 +1,71 @@
+from django.db import transaction
+from .models import Orders, Payment
+
+# Status state machines for bulk changes from the dashboard: the statuses each status may move to, the first
+# one being its next status. A bulk change reads the selected rows once, locked, and applies one UPDATE per
+# target status, guarded by the source statuses so a row changed meanwhile is never moved from the wrong state.
+ORDER_TRANSITIONS = {
+    'Pending': ('Order Confirmed',),
+    'Order Confirmed': ('Out for Delivery',),
+    'Out for Delivery': ('Delivered',),
+    'Delivered': (),
+}
+PAYMENT_TRANSITIONS = {
+    'Pending': ('Paid', 'Due'),
+    'Due': ('Paid',),
+    'Paid': (),
+}
+NEXT = 'next'
+# Below DATA_UPLOAD_MAX_NUMBER_FIELDS (1000), so a full selection still parses and gets its per id results
+MAX_SELECTION = 500
+
+# Per id results
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+NOT_ALLOWED = 'not_allowed'
+NOT_FOUND = 'not_found'
+
+
+def target_status(transitions, status, target):
+    allowed = transitions.get(status, ())
+    if target == NEXT:
+        return allowed[0] if allowed else None
+    return target if target in allowed else None
+
+
+# Move the rows to target (a status, or NEXT for each row's next status), returns {id: result}
+@transaction.atomic
+def change_status(model, field, transitions, ids, target):
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_SELECTION:
+        raise ValueError('At most {} rows can be changed at once'.format(MAX_SELECTION))
+    current = dict(model.objects.select_for_update().filter(id__in=ids).values_list('id', field))
+    results = {}
+    # Target status: (ids, source statuses)
+    moves = {}
+    for row_id in ids:
+        status = current.get(row_id)
+        if row_id not in current:
+            results[row_id] = {'result': NOT_FOUND}
+        elif status == target:
+            results[row_id] = {'result': UNCHANGED, 'status': status}
+        else:
+            new_status = target_status(transitions, status, target)
+            if new_status:
+                row_ids, sources = moves.setdefault(new_status, ([], set()))
+                row_ids.append(row_id)
+                sources.add(status)
+                results[row_id] = {'result': UPDATED, 'from': status, 'status': new_status}
+            else:
+                results[row_id] = {'result': NOT_ALLOWED, 'status': status}
+    for new_status, (row_ids, sources) in moves.items():
+        model.objects.filter(id__in=row_ids, **{field + '__in': sources}).update(**{field: new_status})
+    return results
+
+
+def change_order_status(order_ids, target):
+    return change_status(Orders, 'status', ORDER_TRANSITIONS, order_ids, target)
+
+
+def change_payment_status(payment_ids, target):
+    return change_status(Payment, 'payment_status', PAYMENT_TRANSITIONS, payment_ids, target)
@@ -0,0 +1,79 @@
+from datetime import timedelta
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+from .models import OutboxEmail
+
+# Emails are rendered in the request and stored in the outbox, in the same transaction as the data they talk
+# about, instead of blocking the request on SMTP. The send_outbox_emails command sends them in batches over one
+# connection; failed sends are retried with exponential backoff until MAX_ATTEMPTS.
+PENDING = 'Pending'
+SENT = 'Sent'
+FAILED = 'Failed'
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 6
+RETRY_DELAY = 60
+# A claimed email is retried after this long if its worker died before recording the result
+CLAIM_TIMEOUT = 60 * 10
+
+
+def queue(email):
+    return OutboxEmail.objects.create(subject=email.subject, body=email.body, from_email=email.from_email,
+                                      to=list(email.to), content_subtype=email.content_subtype)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1))
+
+
+# Claim due emails by moving their next attempt past the claim timeout, so concurrent workers skip them
+@transaction.atomic
+def claim(batch_size=BATCH_SIZE):
+    now = timezone.now()
+    emails = list(OutboxEmail.objects.select_for_update(skip_locked=True)
+                  .filter(status=PENDING, next_attempt__lte=now).order_by('next_attempt', 'id')[:batch_size])
+    if emails:
+        OutboxEmail.objects.filter(id__in=[email.id for email in emails]).update(
+            next_attempt=now + timedelta(seconds=CLAIM_TIMEOUT))
+    return emails
+
+
+def record_failure(email, error):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= MAX_ATTEMPTS:
+        email.status = FAILED
+    else:
+        email.next_attempt = timezone.now() + retry_delay(email.attempts)
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+
+
+# Send one batch of due emails over a single connection, returns (sent, failed)
+def send_batch(batch_size=BATCH_SIZE, backend=None):
+    emails = claim(batch_size)
+    if not emails:
+        return 0, 0
+    sent = []
+    failed = 0
+    connection = get_connection(backend)
+    try:
+        connection.open()
+    except Exception as error:
+        for email in emails:
+            record_failure(email, error)
+        return 0, len(emails)
+    try:
+        for email in emails:
+            message = EmailMessage(email.subject, email.body, email.from_email, email.to, connection=connection)
+            message.content_subtype = email.content_subtype
+            try:
+                message.send()
+            except Exception as error:
+                record_failure(email, error)
+                failed += 1
+            else:
+                sent.append(email.id)
+    finally:
+        connection.close()
+    OutboxEmail.objects.filter(id__in=sent).update(status=SENT, date_sent=timezone.now(), last_error='')
+    return len(sent), failed
@@ -0,0 +1,90 @@
+import hashlib
+import re
+from functools import wraps
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from .cache import get_versions, bump_version
+
+# Full page cache for anonymous visitors. A page is stored under the versions of the tags it depends on
+# (the listing, one product, the navigation), so bumping a tag makes every page built from it unreachable.
+PAGE_KEY = 'page:{path}:{versions}'
+TAG_VERSION_KEY = 'page:tag:{tag}'
+PAGE_TIMEOUT = 60 * 5
+
+LISTING_TAG = 'listing'
+NAVIGATION_TAG = 'navigation'
+PRODUCT_TAG = 'product:{slug}'
+
+# CSRF tokens are per visitor, cached pages keep a placeholder that is replaced with a fresh token on every hit
+CSRF_PLACEHOLDER = b'__page_cache_csrf_token__'
+CSRF_INPUT = re.compile(rb'(name=["\']csrfmiddlewaretoken["\'] value=["\'])[^"\']*')
+
+
+def product_tag(slug):
+    return PRODUCT_TAG.format(slug=slug)
+
+
+def tag_keys(tags):
+    return [TAG_VERSION_KEY.format(tag=tag) for tag in tags]
+
+
+def bump_tags(*tags):
+    for key in tag_keys(tags):
+        bump_version(key)
+
+
+def page_key(request, tags):
+    path = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+    versions = '.'.join(str(version) for version in get_versions(tag_keys(tags)))
+    return PAGE_KEY.format(path=path, versions=versions)
+
+
+def is_cacheable(request):
+    # Only anonymous GETs without pending flash messages share a page
+    return (request.method in ('GET', 'HEAD') and not request.user.is_authenticated
+            and not len(messages.get_messages(request)))
+
+
+def store_page(key, request, response):
+    # A cookie the view set belongs to this visitor. The CSRF and session middlewares set theirs after the view,
+    # per request, so they never reach the cached page.
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return
+    if len(messages.get_messages(request)):
+        return
+    content = CSRF_INPUT.sub(rb'\1' + CSRF_PLACEHOLDER, response.content)
+    cache.set(key, {
+        'content': content,
+        'content_type': response['Content-Type'],
+        'meta': getattr(request, 'page_cache_meta', None),
+    }, timeout=PAGE_TIMEOUT)
+
+
+def build_response(request, page):
+    content = page['content']
+    if CSRF_PLACEHOLDER in content:
+        content = content.replace(CSRF_PLACEHOLDER, get_token(request).encode('ascii'))
+    return HttpResponse(content, content_type=page['content_type'])
+
+
+# Cache the view for anonymous visitors. tags(request, *args, **kwargs) names the tags the page depends on;
+# on_hit(request, meta) runs for every cached hit with the request.page_cache_meta the view set when rendering
+def cache_anonymous_page(tags, on_hit=None):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not is_cacheable(request):
+                return view(request, *args, **kwargs)
+            key = page_key(request, tags(request, *args, **kwargs))
+            page = cache.get(key)
+            if page is not None:
+                if on_hit is not None:
+                    on_hit(request, page['meta'])
+                return build_response(request, page)
+            response = view(request, *args, **kwargs)
+            store_page(key, request, response)
+            return response
+        return wrapper
+    return decorator
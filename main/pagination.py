@@ -0,0 +1,122 @@
+from django.core import signing
+from django.db import connection
+from django.db.models import Q
+
+CURSOR_SALT = 'main.pagination.cursor'
+
+
+# One page of a keyset paginated listing, iterable like a Django Page
+class KeysetPage:
+    is_keyset = True
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    @property
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return self.paginator.encode_cursor(self.object_list[-1], 'next')
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return self.paginator.encode_cursor(self.object_list[0], 'previous')
+        return None
+
+
+# Keyset (seek) pagination on (sort column, id). Every page costs one indexed range query whatever its depth,
+# instead of COUNT(*) plus OFFSET/LIMIT. The sort column must not be nullable. Listings that do not show a total
+# pass with_count=False and never count.
+class KeysetPaginator:
+    def __init__(self, objects, per_page, ordering='-id', with_count=True):
+        self.objects = objects
+        self.per_page = per_page
+        self.with_count = with_count
+        self.descending = ordering.startswith('-')
+        self.field = ordering.lstrip('-')
+
+    def encode_cursor(self, obj, direction):
+        value = getattr(obj, self.field)
+        if not isinstance(value, (int, str)):
+            value = str(value)
+        return signing.dumps({'v': value, 'id': obj.pk, 'd': direction}, salt=CURSOR_SALT, compress=True)
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            position = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            return None
+        if not isinstance(position, dict) or position.get('d') not in ('next', 'previous'):
+            return None
+        return position
+
+    def order_by(self, reverse=False):
+        descending = self.descending != reverse
+        prefix = '-' if descending else ''
+        if self.field in ('id', 'pk'):
+            return [prefix + 'id']
+        return [prefix + self.field, prefix + 'id']
+
+    def seek(self, objects, position, reverse=False):
+        # Rows strictly after the cursor in the (possibly reversed) listing order
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        if self.field in ('id', 'pk'):
+            return objects.filter(**{'id__' + lookup: position['id']})
+        return objects.filter(Q(**{self.field + '__' + lookup: position['v']}) |
+                              Q(**{self.field: position['v'], 'id__' + lookup: position['id']}))
+
+    def get_page(self, cursor=None):
+        position = self.decode_cursor(cursor)
+        backwards = position is not None and position['d'] == 'previous'
+        objects = self.objects.order_by(*self.order_by(reverse=backwards))
+        if position is not None:
+            objects = self.seek(objects, position, reverse=backwards)
+        # Fetch one extra row to know whether there is another page in this direction
+        rows = list(objects[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+            return KeysetPage(rows, self, has_next=True, has_previous=has_more)
+        return KeysetPage(rows, self, has_next=has_more, has_previous=position is not None)
+
+    @property
+    def count(self):
+        # Total number of rows, estimated from table statistics for unfiltered PostgreSQL listings
+        if not self.with_count:
+            return None
+        if not hasattr(self, '_count'):
+            self._count = approximate_count(self.objects)
+        return self._count
+
+
+def approximate_count(objects):
+    if connection.vendor == 'postgresql' and not objects.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                           [objects.model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] >= 0:
+            return row[0]
+    return objects.count()
@@ -0,0 +1,59 @@
+from django.core.cache import cache
+from django.db.models import Count, Q
+from .cache import get_version
+from .models import Product, Review
+from .page_cache import TAG_VERSION_KEY, product_tag
+from .pagination import KeysetPaginator
+
+# Product detail page data in a fixed number of queries: the product with its category and brand, one page of
+# approved reviews with their customers, the related products and a cached rating histogram
+REVIEWS_PER_PAGE = 8
+RELATED_PRODUCTS = 4
+RATINGS = (5, 4, 3, 2, 1)
+RATING_HISTOGRAM_KEY = 'product:ratings:{product_id}:{version}'
+RATING_HISTOGRAM_TIMEOUT = 60 * 60
+
+
+def get_product(slug):
+    return Product.objects.select_related('category', 'brand').get(slug=slug)
+
+
+def get_reviews_page(product, cursor=None):
+    reviews = Review.objects.filter(product=product, review_status=True).select_related('customer__user')
+    return KeysetPaginator(reviews, REVIEWS_PER_PAGE, ordering='-id', with_count=False).get_page(cursor)
+
+
+def get_related_products(product):
+    # Related product cards only show product fields, so no join is needed
+    return list(Product.objects.filter(category_id=product.category_id).exclude(id=product.id)[:RELATED_PRODUCTS])
+
+
+def build_rating_histogram(product):
+    counts = Review.objects.filter(product=product, review_status=True).aggregate(
+        **{'rate_{}'.format(rate): Count('id', filter=Q(rate=rate)) for rate in RATINGS})
+    total = sum(counts.values())
+    return [{'rate': rate,
+             'count': counts['rate_{}'.format(rate)],
+             'percent': round(counts['rate_{}'.format(rate)] * 100 / total) if total else 0}
+            for rate in RATINGS]
+
+
+# Number of approved reviews per rating, rebuilt when the product page tag is bumped (approved review changes)
+def get_rating_histogram(product):
+    version = get_version(TAG_VERSION_KEY.format(tag=product_tag(product.slug)))
+    key = RATING_HISTOGRAM_KEY.format(product_id=product.id, version=version)
+    histogram = cache.get(key)
+    if histogram is None:
+        histogram = build_rating_histogram(product)
+        cache.set(key, histogram, timeout=RATING_HISTOGRAM_TIMEOUT)
+    return histogram
+
+
+def load_product_details(slug, cursor=None):
+    product = get_product(slug)
+    return {
+        'product': product,
+        'reviews': get_reviews_page(product, cursor),
+        'rating_histogram': get_rating_histogram(product),
+        'related_products': get_related_products(product),
+    }
@@ -0,0 +1,132 @@
+import re
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+# Full text search over products. The search document (product name, category name, brand name and slug) lives in
+# the ProductSearch table: a tsvector with a GIN index on PostgreSQL, an FTS5 virtual table on SQLite.
+SEARCH_TABLE = 'ProductSearch'
+
+POSTGRES_DOCUMENT = """
+    setweight(to_tsvector('simple', coalesce(p.name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(c.name, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(b.name, '')), 'B') ||
+    setweight(to_tsvector('simple', replace(coalesce(p.slug, ''), '-', ' ')), 'C')
+"""
+
+SOURCE_JOINS = """
+    FROM "Product" p
+    LEFT JOIN "Category" c ON c.id = p.category_id
+    LEFT JOIN "Brand" b ON b.id = p.brand_id
+"""
+
+
+# Remember per database whether the search table exists, so searching does not introspect on every request
+_supported = {}
+
+
+def is_supported():
+    alias = connection.alias
+    if alias not in _supported:
+        _supported[alias] = (connection.vendor in ('postgresql', 'sqlite') and
+                             SEARCH_TABLE in connection.introspection.table_names())
+    return _supported[alias]
+
+
+# Split the search query into lowercase word tokens, every token is matched as a prefix
+def tokenize(search_query):
+    return re.findall(r'\w+', (search_query or '').lower())
+
+
+def build_match(tokens):
+    if connection.vendor == 'postgresql':
+        return ' & '.join('{}:*'.format(token) for token in tokens)
+    return ' '.join('"{}"*'.format(token) for token in tokens)
+
+
+def match_sql():
+    if connection.vendor == 'postgresql':
+        return ('SELECT product_id FROM "{table}" WHERE document @@ to_tsquery(\'simple\', %s)'.format(
+            table=SEARCH_TABLE))
+    return 'SELECT rowid FROM "{table}" WHERE "{table}" MATCH %s'.format(table=SEARCH_TABLE)
+
+
+def rank_sql():
+    # Higher is more relevant on both backends (bm25 returns lower-is-better values, so it is negated)
+    if connection.vendor == 'postgresql':
+        return ('SELECT ts_rank(document, to_tsquery(\'simple\', %s)) FROM "{table}" '
+                'WHERE product_id = "Product".id'.format(table=SEARCH_TABLE))
+    return ('SELECT -bm25("{table}", 10.0, 5.0, 5.0, 1.0) FROM "{table}" '
+            'WHERE "{table}" MATCH %s AND rowid = "Product".id'.format(table=SEARCH_TABLE))
+
+
+def fallback_search(products, search_query):
+    return products.filter(
+        Q(name__icontains=search_query) | Q(category__name__icontains=search_query) | Q(
+            brand__name__icontains=search_query) | Q(slug__icontains=search_query)
+    )
+
+
+# Filter products by the search query
+def filter_products(products, search_query):
+    tokens = tokenize(search_query)
+    if not tokens or not is_supported():
+        return fallback_search(products, search_query)
+    return products.filter(id__in=RawSQL(match_sql(), [build_match(tokens)]))
+
+
+# Filter products by the search query and annotate search_rank (relevance, higher is better)
+def search_products(products, search_query):
+    tokens = tokenize(search_query)
+    if not tokens or not is_supported():
+        return fallback_search(products, search_query).annotate(search_rank=RawSQL('0', []))
+    match = build_match(tokens)
+    return products.filter(id__in=RawSQL(match_sql(), [match])).annotate(search_rank=RawSQL(rank_sql(), [match]))
+
+
+# Index maintenance
+def index_products(product_ids=None):
+    if not is_supported():
+        return
+    where, params = '', []
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        where = 'WHERE p.id IN ({})'.format(', '.join(['%s'] * len(product_ids)))
+        params = product_ids
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                'INSERT INTO "{table}" (product_id, document) SELECT p.id, {document} {joins} {where} '
+                'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document'.format(
+                    table=SEARCH_TABLE, document=POSTGRES_DOCUMENT, joins=SOURCE_JOINS, where=where),
+                params)
+        else:
+            remove_products(product_ids, cursor=cursor)
+            cursor.execute(
+                'INSERT INTO "{table}" (rowid, name, category, brand, slug) '
+                'SELECT p.id, coalesce(p.name, \'\'), coalesce(c.name, \'\'), coalesce(b.name, \'\'), '
+                'replace(coalesce(p.slug, \'\'), \'-\', \' \') {joins} {where}'.format(
+                    table=SEARCH_TABLE, joins=SOURCE_JOINS, where=where),
+                params)
+
+
+def remove_products(product_ids=None, cursor=None):
+    if cursor is None:
+        if not is_supported():
+            return
+        with connection.cursor() as cursor:
+            return remove_products(product_ids, cursor=cursor)
+    column = 'product_id' if connection.vendor == 'postgresql' else 'rowid'
+    if product_ids is None:
+        cursor.execute('DELETE FROM "{table}"'.format(table=SEARCH_TABLE))
+    elif product_ids:
+        product_ids = list(product_ids)
+        cursor.execute('DELETE FROM "{table}" WHERE {column} IN ({ids})'.format(
+            table=SEARCH_TABLE, column=column, ids=', '.join(['%s'] * len(product_ids))), product_ids)
+
+
+def rebuild_index():
+    remove_products()
+    index_products()
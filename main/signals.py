@@ -0,0 +1,131 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+from . import search
+from .leaderboards import LEADERBOARD_FIELDS, update_leaderboards
+from .cache import bump_navigation_version, bump_catalog_version
+from .coupons import bump_coupon_version
+from .models import Category, Brand, Product, Review, Coupon
+from .page_cache import LISTING_TAG, NAVIGATION_TAG, bump_tags, product_tag
+
+# Product fields that change what the navigation shows
+PRODUCT_NAVIGATION_FIELDS = {'category', 'brand'}
+# Product fields that are part of the search document
+PRODUCT_SEARCH_FIELDS = {'name', 'slug', 'category', 'brand'}
+# Product counters that change on their own (views, sales, reviews) and do not invalidate catalog caches
+PRODUCT_COUNTER_FIELDS = {'view_count', 'sold', 'stock', 'profit', 'review_rate_average', 'review_count'}
+
+
+def changes_any(update_fields, fields):
+    return not update_fields or bool(fields & set(update_fields))
+
+
+# Invalidate the cached navigation when the catalog changes
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_navigation(sender, update_fields=None, **kwargs):
+    if sender is Product and not changes_any(update_fields, PRODUCT_NAVIGATION_FIELDS):
+        return
+    transaction.on_commit(bump_navigation_version)
+
+
+# Invalidate catalog caches (facets, price buckets) when storefront data changes
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalog(sender, update_fields=None, **kwargs):
+    if sender is Product and update_fields and set(update_fields) <= PRODUCT_COUNTER_FIELDS:
+        return
+    transaction.on_commit(bump_catalog_version)
+
+
+# Remember the slug a product is saved over, the page cached under the old slug must go too
+@receiver(pre_save, sender=Product)
+def remember_previous_slug(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or (update_fields and 'slug' not in update_fields):
+        return
+    instance._previous_slug = Product.objects.filter(pk=instance.pk).values_list('slug', flat=True).first()
+
+
+# Invalidate cached anonymous pages: every page shows the listing and navigation, product pages their reviews
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_pages(sender, instance, update_fields=None, **kwargs):
+    if sender is Product and update_fields and set(update_fields) <= PRODUCT_COUNTER_FIELDS:
+        # Stock and sales changes only show on the product page, listings catch up when their pages expire
+        tag = product_tag(instance.slug)
+        transaction.on_commit(lambda: bump_tags(tag))
+        return
+    tags = [LISTING_TAG]
+    if sender is not Product or changes_any(update_fields, PRODUCT_NAVIGATION_FIELDS):
+        tags.append(NAVIGATION_TAG)
+    if sender is Product:
+        tags.append(product_tag(instance.slug))
+        previous_slug = getattr(instance, '_previous_slug', None)
+        if previous_slug and previous_slug != instance.slug:
+            tags.append(product_tag(previous_slug))
+    transaction.on_commit(lambda: bump_tags(*tags))
+
+
+# Only approved reviews are shown, a review that was never approved changes no page
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review_pages(sender, instance, created=False, **kwargs):
+    if not instance.review_status and (created or kwargs.get('signal') is post_delete):
+        return
+    slug = Product.objects.filter(id=instance.product_id).values_list('slug', flat=True).first()
+    if slug is not None:
+        transaction.on_commit(lambda: bump_tags(product_tag(slug)))
+
+
+# Move products whose counters were saved within the leaderboards. Any other product save bumps the catalog
+# version in invalidate_catalog, the version is part of the board keys, so the boards are rebuilt on the next read.
+@receiver(post_save, sender=Product)
+def update_product_leaderboards(sender, instance, update_fields=None, **kwargs):
+    if not update_fields or not set(update_fields) <= PRODUCT_COUNTER_FIELDS:
+        return
+    fields = [field for field in LEADERBOARD_FIELDS if field in update_fields]
+    if fields:
+        transaction.on_commit(lambda: update_leaderboards([instance], fields))
+
+
+# Keep the product search index in sync
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, update_fields=None, **kwargs):
+    if changes_any(update_fields, PRODUCT_SEARCH_FIELDS):
+        product_ids = [instance.pk]
+        transaction.on_commit(lambda: search.index_products(product_ids))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    product_ids = [instance.pk]
+    transaction.on_commit(lambda: search.remove_products(product_ids))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Brand)
+def index_catalog_products(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    lookup = 'category' if sender is Category else 'brand'
+    product_ids = list(Product.objects.filter(**{lookup: instance}).values_list('id', flat=True))
+    transaction.on_commit(lambda: search.index_products(product_ids))
+
+
+# Cached coupon metadata follows every coupon change made through the models (the dashboard)
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def invalidate_coupons(sender, **kwargs):
+    transaction.on_commit(bump_coupon_version)
@@ -0,0 +1,55 @@
+// Search box autocomplete
+document.querySelectorAll('.search-manage-input').forEach(function (input) {
+    let list = document.createElement('ul');
+    let timer = null;
+    list.className = 'autocomplete-list';
+    list.hidden = true;
+    input.setAttribute('autocomplete', 'off');
+    input.parentNode.appendChild(list);
+
+    function render(results) {
+        list.innerHTML = '';
+        results.forEach(function (result) {
+            let item = document.createElement('li');
+            let link = document.createElement('a');
+            let name = document.createElement('span');
+            let type = document.createElement('span');
+            link.href = result.url;
+            name.textContent = result.name;
+            type.textContent = result.type;
+            type.className = 'autocomplete-type';
+            link.appendChild(name);
+            link.appendChild(type);
+            item.appendChild(link);
+            list.appendChild(item);
+        });
+        list.hidden = results.length === 0;
+    }
+
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        let query = input.value.trim();
+        if (!query) {
+            render([]);
+            return;
+        }
+        timer = setTimeout(function () {
+            fetch('/customer/product/autocomplete/?q=' + encodeURIComponent(query))
+                .then(function (response) {
+                    return response.json();
+                })
+                .then(function (data) {
+                    if (input.value.trim() === query) {
+                        render(data.results);
+                    }
+                });
+        }, 150);
+    });
+
+    input.addEventListener('blur', function () {
+        // Let a click on a suggestion land before hiding the list
+        setTimeout(function () {
+            list.hidden = true;
+        }, 200);
+    });
+});
@@ -0,0 +1,32 @@
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.utils import timezone
+from .models import Brand, Category, Coupon, Customer, DeliveryAddress, Product
+
+
+# Model factories shared by the test modules of every app
+def create_customer(username):
+    user = User.objects.create_user(username=username, email='{}@example.com'.format(username), password='secret',
+                                    first_name=username, last_name='Tester')
+    return Customer.objects.create(user=user, mobile='0123456789', address='1 Test Street')
+
+
+def create_product(slug, stock=10, price=100, category=None, brand=None, name=None):
+    if category is None:
+        category, _ = Category.objects.get_or_create(slug='phones', defaults={'name': 'Phones'})
+    if brand is None:
+        brand, _ = Brand.objects.get_or_create(slug='acme', defaults={'name': 'Acme'})
+    return Product.objects.create(slug=slug, name=name or slug, category=category, brand=brand, stock=stock,
+                                  price=price, price_original=price - 20, old_price=price + 20)
+
+
+def create_address(customer, email='delivery@example.com'):
+    return DeliveryAddress.objects.create(customer=customer, first_name='Test', last_name='Tester',
+                                          mobile='0123456789', email=email, address='1 Test Street', city='Hanoi',
+                                          state='Hanoi', country='Vietnam', zip_code='100000', is_default=True)
+
+
+def create_coupon(code, amount, discount=10):
+    now = timezone.now()
+    return Coupon.objects.create(code=code, discount=discount, amount=amount, valid_from=now - timedelta(days=1),
+                                 valid_to=now + timedelta(days=1))
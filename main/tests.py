@@ -1,3 +1,931 @@
-from django.test import TestCase
+import smtplib
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.contrib import messages
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.test import RequestFactory, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.utils import timezone
+from . import autocomplete, badges, cart, counters, coupons, facets, inventory, leaderboards, outbox, page_cache, \
+    search, transaction_ids
+from .cache import get_versions
+from .checkout import OutOfStock, place_order
+from .pagination import KeysetPaginator
+from .transaction_ids import new_transaction_id
+from .models import Brand, CartItem, Category, Coupon, CouponRedemption, InventoryHold, OrderDetails, OutboxEmail, \
+    Orders, Payment, Product, Wishlist
+from .testing import create_address, create_coupon, create_customer, create_product
 
-# Create your tests here.
+
+class CartTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = create_customer('shopper')
+        self.product = create_product('acme-phone', stock=5)
+
+    def line(self):
+        return CartItem.objects.get(customer=self.customer, product=self.product)
+
+    def test_add_merges_into_the_existing_line(self):
+        self.assertEqual(cart.add_item(self.customer, self.product.slug), (cart.ADDED, 1))
+        self.assertEqual(cart.add_item(self.customer, self.product.slug, 2), (cart.UPDATED, 3))
+        self.assertEqual(CartItem.objects.filter(customer=self.customer).count(), 1)
+        line = self.line()
+        self.assertEqual(line.quantity, 3)
+        self.assertEqual(line.sub_total, 300)
+
+    def test_add_beyond_stock_leaves_the_line_alone(self):
+        cart.add_item(self.customer, self.product.slug, 4)
+        self.assertEqual(cart.add_item(self.customer, self.product.slug, 2), (cart.OUT_OF_STOCK, None))
+        self.assertEqual(self.line().quantity, 4)
+
+    def test_add_unknown_product(self):
+        self.assertEqual(cart.add_item(self.customer, 'missing'), (cart.NOT_FOUND, None))
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_change_quantity_to_zero_removes_the_line(self):
+        cart.add_item(self.customer, self.product.slug, 2)
+        self.assertEqual(cart.change_quantity(self.customer, self.product.slug, 1), (cart.UPDATED, 3))
+        self.assertEqual(cart.change_quantity(self.customer, self.product.slug, 3), (cart.OUT_OF_STOCK, None))
+        self.assertEqual(cart.change_quantity(self.customer, self.product.slug, -3), (cart.REMOVED, 0))
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_cart_summary_totals(self):
+        coupon = create_coupon('SAVE10', amount=5)
+        tablet = create_product('acme-tablet', price=200)
+        cart.add_item(self.customer, self.product.slug, 2)
+        cart.add_item(self.customer, tablet.slug)
+        coupons.apply_cart_coupon(self.customer, coupon, 3)
+        with self.assertNumQueries(2):
+            summary = cart.cart_summary(self.customer)
+            self.assertEqual({(item.product.slug, item.coupon.code) for item in summary['items']},
+                             {('acme-phone', 'SAVE10'), ('acme-tablet', 'SAVE10')})
+        del summary['items']
+        self.assertEqual(summary, {'total': 370, 'total_amount_without_coupon': 400, 'total_amount_with_coupon': 370,
+                                   'discount': 30, 'code': 'SAVE10', 'quantity': 3, 'count': 2})
+
+    def test_empty_cart_totals(self):
+        self.assertEqual(cart.cart_totals(self.customer), {
+            'total': 0, 'total_amount_without_coupon': 0, 'total_amount_with_coupon': 0, 'discount': 0, 'code': None,
+            'quantity': 0, 'count': 0})
+
+    def test_wishlist_moves_what_the_stock_covers(self):
+        coupon = create_coupon('SAVE10', amount=10)
+        full = self.product
+        sold_out = create_product('acme-watch', stock=0)
+        tablet = create_product('acme-tablet', price=200)
+        cart.add_item(self.customer, full.slug, 5)
+        coupons.apply_cart_coupon(self.customer, coupon, 5)
+        for product in (full, sold_out, tablet):
+            Wishlist.objects.create(customer=self.customer, product=product)
+
+        self.assertEqual(cart.add_wishlist(self.customer), (1, 2))
+        self.assertEqual(set(Wishlist.objects.values_list('product__slug', flat=True)), {'acme-phone', 'acme-watch'})
+        self.assertEqual(self.line().quantity, 5)
+        line = CartItem.objects.get(customer=self.customer, product=tablet)
+        # The new line takes the cart coupon and reserves its unit
+        self.assertEqual((line.quantity, line.coupon_id, line.discount, line.sub_total), (1, coupon.id, 10, 190))
+        self.assertEqual(CouponRedemption.objects.get(customer=self.customer, order=None).quantity, 6)
+        self.assertEqual(Coupon.objects.get(id=coupon.id).amount, 4)
+        self.assertFalse(CartItem.objects.filter(product=sold_out).exists())
+
+
+class CouponReservationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = create_customer('shopper')
+        self.product = create_product('acme-phone')
+        self.coupon = create_coupon('SAVE10', amount=3)
+
+    def amount(self):
+        return Coupon.objects.get(id=self.coupon.id).amount
+
+    def reserved(self, customer=None):
+        redemption = CouponRedemption.objects.filter(customer=customer or self.customer, order=None).first()
+        return redemption.quantity if redemption else 0
+
+    def test_reservation_over_the_limit_is_refused(self):
+        self.assertTrue(coupons.reserve(self.customer, self.coupon.id, 2))
+        self.assertFalse(coupons.reserve(self.customer, self.coupon.id, 2))
+        self.assertEqual(self.amount(), 1)
+        self.assertEqual(self.reserved(), 2)
+
+    def test_release_gives_units_back(self):
+        coupons.reserve(self.customer, self.coupon.id, 3)
+        self.assertEqual(coupons.release(self.customer, 1), 1)
+        self.assertEqual((self.amount(), self.reserved()), (1, 2))
+        self.assertEqual(coupons.release(self.customer), 2)
+        self.assertEqual((self.amount(), self.reserved()), (3, 0))
+        self.assertFalse(CouponRedemption.objects.exists())
+
+    def test_reservation_follows_the_cart_quantity(self):
+        cart.add_item(self.customer, self.product.slug)
+        self.assertTrue(coupons.apply_cart_coupon(self.customer, self.coupon, 1))
+        self.assertEqual((self.amount(), self.reserved()), (2, 1))
+
+        cart.change_quantity(self.customer, self.product.slug, 2)
+        self.assertEqual((self.amount(), self.reserved()), (0, 3))
+        line = CartItem.objects.get(customer=self.customer)
+        self.assertEqual((line.discount, line.sub_total), (30, 270))
+
+        cart.change_quantity(self.customer, self.product.slug, -1)
+        self.assertEqual((self.amount(), self.reserved()), (1, 2))
+        cart.remove_item(self.customer, self.product.slug)
+        self.assertEqual((self.amount(), self.reserved()), (3, 0))
+
+    def test_quantity_beyond_the_coupon_units_drops_the_coupon(self):
+        cart.add_item(self.customer, self.product.slug)
+        coupons.apply_cart_coupon(self.customer, self.coupon, 1)
+        cart.change_quantity(self.customer, self.product.slug, 3)
+        line = CartItem.objects.get(customer=self.customer)
+        self.assertEqual((line.quantity, line.coupon_applied, line.discount), (4, False, 0))
+        self.assertEqual((self.amount(), self.reserved()), (3, 0))
+
+    def lines(self, *products):
+        lines = {line.product_id: line for line in CartItem.objects.filter(customer=self.customer)}
+        return [(line.price, line.discount, line.sub_total, line.coupon_id, line.coupon_applied)
+                for line in (lines[product.id] for product in products)]
+
+    def test_apply_and_clear_reprice_every_line(self):
+        tablet = create_product('acme-tablet', price=200)
+        cart.add_item(self.customer, self.product.slug, 2)
+        cart.add_item(self.customer, tablet.slug)
+        # The price changed after the line was added, repricing picks up the current one
+        Product.objects.filter(id=self.product.id).update(price=120)
+        self.assertTrue(coupons.apply_cart_coupon(self.customer, self.coupon, 3))
+        self.assertEqual(self.lines(self.product, tablet), [(120, 20, 220, self.coupon.id, True),
+                                                            (200, 10, 190, self.coupon.id, True)])
+        self.assertEqual(coupons.clear_cart_coupon(self.customer), 3)
+        self.assertEqual(self.lines(self.product, tablet), [(120, 0, 240, None, False), (200, 0, 200, None, False)])
+        self.assertEqual(self.amount(), 3)
+
+    def test_coupon_without_units_leaves_the_cart_alone(self):
+        cart.add_item(self.customer, self.product.slug, 4)
+        self.assertFalse(coupons.apply_cart_coupon(self.customer, self.coupon, 4))
+        self.assertEqual(self.lines(self.product), [(100, 0, 400, None, False)])
+        self.assertEqual((self.amount(), self.reserved()), (3, 0))
+
+    def test_reprice_is_one_update_for_any_cart_size(self):
+        for index in range(5):
+            cart.add_item(self.customer, create_product('acme-phone-{}'.format(index)).slug)
+        with self.assertNumQueries(1):
+            self.assertEqual(coupons.reprice_cart(self.customer, self.coupon), 5)
+
+    def test_release_carts(self):
+        other = create_customer('other')
+        second = create_coupon('SAVE20', amount=5)
+        coupons.reserve(self.customer, self.coupon.id, 2)
+        coupons.reserve(other, second.id, 4)
+        self.assertEqual(coupons.release_carts([self.customer.id, other.id]), 6)
+        self.assertEqual(self.amount(), 3)
+        self.assertEqual(Coupon.objects.get(id=second.id).amount, 5)
+        self.assertFalse(CouponRedemption.objects.exists())
+
+
+class CouponCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.coupon = create_coupon('SAVE10', amount=3)
+
+    def test_metadata_is_read_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(coupons.get_valid_coupon(' SAVE10 ').id, self.coupon.id)
+        with self.assertNumQueries(0):
+            coupon = coupons.get_valid_coupon('SAVE10')
+        self.assertEqual((coupon.code, coupon.discount), ('SAVE10', 10))
+
+    def test_unknown_and_invalid_codes_do_not_reach_the_database(self):
+        coupons.get_valid_coupon('GUESS')
+        with self.assertNumQueries(0):
+            self.assertIsNone(coupons.get_valid_coupon('GUESS'))
+            self.assertIsNone(coupons.get_valid_coupon(''))
+            self.assertIsNone(coupons.get_valid_coupon('X' * 1000))
+        self.assertEqual(cache.get(coupons.COUPON_KEY.format(
+            code='GUESS', version=cache.get(coupons.COUPON_VERSION_KEY))), coupons.MISSING)
+
+    def test_coupon_changes_invalidate_the_cache(self):
+        coupons.get_valid_coupon('SAVE10')
+        coupons.get_valid_coupon('NEW20')
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon = Coupon.objects.get(id=self.coupon.id)
+            coupon.discount = 15
+            coupon.save()
+            create_coupon('NEW20', amount=1, discount=20)
+        self.assertEqual(coupons.get_valid_coupon('SAVE10').discount, 15)
+        self.assertEqual(coupons.get_valid_coupon('NEW20').discount, 20)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon.is_active = False
+            coupon.save()
+        self.assertIsNone(coupons.get_valid_coupon('SAVE10'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Coupon.objects.get(code='NEW20').delete()
+        self.assertIsNone(coupons.get_valid_coupon('NEW20'))
+
+    def test_expired_coupon_is_not_valid(self):
+        Coupon.objects.filter(id=self.coupon.id).update(valid_to=timezone.now() - timedelta(minutes=1))
+        self.assertIsNone(coupons.get_valid_coupon('SAVE10'))
+
+
+class SweepCartsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cutoff = timezone.now() - timedelta(days=30)
+        self.coupon = create_coupon('SAVE10', amount=5)
+        self.products = [create_product('acme-phone-{}'.format(index)) for index in range(2)]
+
+    def fill_cart(self, customer, days_old):
+        for product in self.products:
+            cart.add_item(customer, product.slug)
+        coupons.apply_cart_coupon(customer, self.coupon, len(self.products))
+        CartItem.objects.filter(customer=customer).update(date_added=timezone.now() - timedelta(days=days_old))
+
+    def test_idle_carts_are_emptied_and_their_coupon_units_released(self):
+        idle = create_customer('idle')
+        active = create_customer('active')
+        self.fill_cart(idle, 40)
+        self.fill_cart(active, 1)
+        self.assertEqual(list(cart.idle_carts(self.cutoff)), [idle.id])
+        self.assertEqual(cart.sweep_carts([idle.id], self.cutoff), (1, 2, 2))
+        self.assertFalse(CartItem.objects.filter(customer=idle).exists())
+        self.assertEqual(CartItem.objects.filter(customer=active).count(), 2)
+        self.assertEqual(Coupon.objects.get(id=self.coupon.id).amount, 3)
+
+    def test_cart_added_to_after_selection_is_kept(self):
+        customer = create_customer('shopper')
+        self.fill_cart(customer, 40)
+        customer_ids = list(cart.idle_carts(self.cutoff))
+        cart.add_item(customer, create_product('acme-tablet').slug)
+        self.assertEqual(cart.sweep_carts(customer_ids, self.cutoff), (0, 0, 0))
+        self.assertEqual(CartItem.objects.filter(customer=customer).count(), 3)
+        self.assertEqual(CouponRedemption.objects.get(customer=customer).quantity, 3)
+
+
+class PlaceOrderTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = create_customer('shopper')
+        self.address = create_address(self.customer)
+        self.phone = create_product('acme-phone', stock=5)
+        self.tablet = create_product('acme-tablet', stock=5, price=200)
+        cart.add_item(self.customer, self.phone.slug, 2)
+        cart.add_item(self.customer, self.tablet.slug, 3)
+
+    def stock(self, product):
+        return Product.objects.values_list('stock', 'sold').get(id=product.id)
+
+    def test_order_takes_the_stock_and_empties_the_cart(self):
+        order, order_details = place_order(self.customer, self.address, 'Cash on Delivery')
+        self.assertEqual((order.sub_total, order.total_amount), (800, 800))
+        self.assertEqual(len(order_details), 2)
+        self.assertEqual(self.stock(self.phone), (3, 2))
+        self.assertEqual(self.stock(self.tablet), (2, 3))
+        self.assertFalse(CartItem.objects.filter(customer=self.customer).exists())
+        self.assertEqual(Payment.objects.get(order=order).total, 800)
+
+    def test_stock_running_short_rolls_the_order_back(self):
+        Product.objects.filter(id=self.tablet.id).update(stock=2)
+        with self.assertRaises(OutOfStock) as raised:
+            place_order(self.customer, self.address, 'Cash on Delivery')
+        self.assertEqual(raised.exception.product.id, self.tablet.id)
+        # The phone was decremented before the tablet came up short, the whole order is rolled back
+        self.assertEqual(self.stock(self.phone), (5, 0))
+        self.assertEqual(self.stock(self.tablet), (2, 0))
+        self.assertFalse(Orders.objects.exists())
+        self.assertFalse(OrderDetails.objects.exists())
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(CartItem.objects.filter(customer=self.customer).count(), 2)
+
+    def test_empty_cart_places_nothing(self):
+        CartItem.objects.filter(customer=self.customer).delete()
+        self.assertEqual(place_order(self.customer, self.address, 'Cash on Delivery'), (None, []))
+        self.assertFalse(Orders.objects.exists())
+
+    def test_taken_transaction_id_is_retried_with_a_new_one(self):
+        # Another process with the same worker id generated this id first
+        taken = new_transaction_id()
+        Payment.objects.create(customer=self.customer, payment_method='Cash on Delivery', payment_status='Paid',
+                               total=10, transaction_id=taken)
+        fresh = new_transaction_id()
+        with mock.patch('main.checkout.new_transaction_id', side_effect=[taken, fresh]):
+            order, order_details = place_order(self.customer, self.address, 'Cash on Delivery')
+        self.assertEqual(Payment.objects.get(order=order).transaction_id, fresh)
+        self.assertEqual(self.stock(self.phone), (3, 2))
+        self.assertFalse(CartItem.objects.filter(customer=self.customer).exists())
+
+
+LOCMEM_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+
+# Locmem backend that refuses every message sent to a bounce address
+class BouncingBackend(EmailBackend):
+    def send_messages(self, messages):
+        for message in messages:
+            if any(address.startswith('bounce') for address in message.to):
+                raise smtplib.SMTPRecipientsRefused({address: (550, b'No such user') for address in message.to})
+        return super().send_messages(messages)
+
+
+class OutboxTest(TestCase):
+    def queue(self, to='shopper@example.com', subject='Order placed successfully.'):
+        email = EmailMessage(subject, '<p>Thank you</p>', 'LCL Shop <lclshop.dev@gmail.com>', [to])
+        email.content_subtype = 'html'
+        return outbox.queue(email)
+
+    def make_due(self):
+        OutboxEmail.objects.filter(status=outbox.PENDING).update(next_attempt=timezone.now())
+
+    def test_queue_stores_a_pending_email(self):
+        email = self.queue()
+        self.assertEqual((email.status, email.attempts, email.to), (outbox.PENDING, 0, ['shopper@example.com']))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_send_batch_sends_and_marks_sent(self):
+        email = self.queue()
+        self.assertEqual(outbox.send_batch(backend=LOCMEM_BACKEND), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['shopper@example.com'])
+        self.assertEqual(mail.outbox[0].content_subtype, 'html')
+        email.refresh_from_db()
+        self.assertEqual(email.status, outbox.SENT)
+        self.assertIsNotNone(email.date_sent)
+        self.assertEqual(outbox.send_batch(backend=LOCMEM_BACKEND), (0, 0))
+
+    def test_claimed_emails_are_not_claimed_again(self):
+        for index in range(3):
+            self.queue(to='shopper{}@example.com'.format(index))
+        claimed = outbox.claim(batch_size=2)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual([email.id for email in outbox.claim()],
+                         list(OutboxEmail.objects.exclude(id__in=[email.id for email in claimed])
+                              .values_list('id', flat=True)))
+        self.assertEqual(outbox.claim(), [])
+
+    def test_failed_send_is_retried_with_backoff(self):
+        self.queue(to='bounce@example.com')
+        self.queue()
+        started = timezone.now()
+        self.assertEqual(outbox.send_batch(backend='main.tests.BouncingBackend'), (1, 1))
+        email = OutboxEmail.objects.get(to=['bounce@example.com'])
+        self.assertEqual((email.status, email.attempts), (outbox.PENDING, 1))
+        self.assertIn('No such user', email.last_error)
+        self.assertGreaterEqual(email.next_attempt, started + outbox.retry_delay(1))
+        # Not due before its retry delay
+        self.assertEqual(outbox.send_batch(backend='main.tests.BouncingBackend'), (0, 0))
+
+        self.make_due()
+        retried = timezone.now()
+        outbox.send_batch(backend='main.tests.BouncingBackend')
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 2)
+        self.assertGreaterEqual(email.next_attempt, retried + outbox.retry_delay(2))
+        self.assertEqual(outbox.retry_delay(2), outbox.retry_delay(1) * 2)
+
+    def test_email_fails_after_max_attempts(self):
+        email = self.queue(to='bounce@example.com')
+        for attempt in range(outbox.MAX_ATTEMPTS):
+            self.make_due()
+            self.assertEqual(outbox.send_batch(backend='main.tests.BouncingBackend'), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (outbox.FAILED, outbox.MAX_ATTEMPTS))
+        self.make_due()
+        self.assertEqual(outbox.send_batch(backend='main.tests.BouncingBackend'), (0, 0))
+
+    def test_command_drains_the_outbox(self):
+        for index in range(5):
+            self.queue(to='shopper{}@example.com'.format(index))
+        output = StringIO()
+        call_command('send_outbox_emails', batch_size=2, backend=LOCMEM_BACKEND, stdout=output)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(OutboxEmail.objects.exclude(status=outbox.SENT).exists())
+        self.assertIn('Outbox drained', output.getvalue())
+
+
+@skipUnlessDBFeature('has_select_for_update_skip_locked')
+class OutboxClaimLockTest(TransactionTestCase):
+    def test_claim_skips_emails_locked_by_another_worker(self):
+        first, second = [outbox.queue(EmailMessage('Subject', 'Body', 'shop@example.com', [to]))
+                         for to in ('first@example.com', 'second@example.com')]
+        locked = threading.Event()
+        done = threading.Event()
+
+        # Another worker holds the row lock of the first email in its own transaction
+        def worker():
+            try:
+                with transaction.atomic():
+                    list(OutboxEmail.objects.select_for_update().filter(id=first.id))
+                    locked.set()
+                    done.wait(10)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            claimed = outbox.claim()
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual([email.id for email in claimed], [second.id])
+
+
+class InventoryHoldTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = create_product('acme-phone', stock=5)
+        self.holder = create_customer('holder')
+        self.other = create_customer('other')
+        cart.add_item(self.holder, self.product.slug, 4)
+        self.assertEqual(inventory.hold_cart(self.holder), [])
+
+    def test_held_stock_cannot_be_held_by_another_customer(self):
+        cart.add_item(self.other, self.product.slug, 2)
+        self.assertEqual(inventory.hold_cart(self.other), [self.product])
+        self.assertFalse(InventoryHold.objects.filter(customer=self.other).exists())
+        cart.change_quantity(self.other, self.product.slug, -1)
+        self.assertEqual(inventory.hold_cart(self.other), [])
+
+    def test_held_stock_cannot_be_taken_by_another_customer(self):
+        cart.add_item(self.other, self.product.slug, 2)
+        with self.assertRaises(OutOfStock):
+            place_order(self.other, create_address(self.other), 'Cash on Delivery')
+        self.assertEqual(Product.objects.get(id=self.product.id).stock, 5)
+        self.assertTrue(inventory.take_stock(self.other, self.product.id, 1))
+        self.assertFalse(inventory.take_stock(self.other, self.product.id, 1))
+
+    def test_holder_takes_its_own_held_stock(self):
+        order, _ = place_order(self.holder, create_address(self.holder), 'Cash on Delivery')
+        self.assertIsNotNone(order)
+        self.assertEqual(Product.objects.get(id=self.product.id).stock, 1)
+        self.assertFalse(InventoryHold.objects.exists())
+
+    def test_expired_holds_do_not_count(self):
+        InventoryHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        cart.add_item(self.other, self.product.slug, 5)
+        self.assertEqual(inventory.hold_cart(self.other), [])
+        self.assertEqual(list(InventoryHold.objects.values_list('customer_id', 'quantity')), [(self.other.id, 5)])
+
+
+class TransactionIdTest(TestCase):
+    def test_ids_are_unique_and_strictly_increasing(self):
+        ids = [new_transaction_id() for _ in range(20000)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertTrue(all(len(value) == transaction_ids.ID_DIGITS and value.isdigit() for value in ids))
+        self.assertTrue(all(int(previous) < int(value) for previous, value in zip(ids, ids[1:])))
+
+    def test_ids_keep_increasing_when_the_clock_goes_back(self):
+        first = new_transaction_id()
+        with mock.patch('main.transaction_ids.now_ms', return_value=transaction_ids.now_ms() - 60000):
+            later = [new_transaction_id() for _ in range(10)]
+        self.assertEqual([first] + later, sorted(set([first] + later)))
+
+    def test_ids_from_concurrent_threads_are_unique(self):
+        ids = []
+
+        def generate():
+            ids.extend(new_transaction_id() for _ in range(2000))
+
+        threads = [threading.Thread(target=generate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(ids)), 8000)
+
+
+class ProductSearchTest(TestCase):
+    def setUp(self):
+        if not search.is_supported():
+            self.skipTest('No full text search table on this database')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.samsung = Brand.objects.create(slug='samsung', name='Samsung')
+            gear = Brand.objects.create(slug='galaxy-gear', name='Galaxy Gear')
+            accessories = Category.objects.create(slug='accessories', name='Accessories')
+            self.phone = create_product('galaxy-s23', name='Galaxy S23', brand=self.samsung)
+            self.case = create_product('leather-case', name='Leather Case', category=accessories, brand=gear)
+            self.charger = create_product('usb-charger', name='USB Charger', category=accessories)
+
+    def search(self, search_query):
+        products = search.search_products(Product.objects.all(), search_query).order_by('-search_rank', 'id')
+        return [product.id for product in products]
+
+    def test_tokens_match_as_prefixes_and_all_must_match(self):
+        self.assertEqual(set(self.search('gal')), {self.phone.id, self.case.id})
+        self.assertEqual(self.search('GALAXY s2'), [self.phone.id])
+        self.assertEqual(self.search('s23 galaxy'), [self.phone.id])
+        self.assertEqual(self.search('galaxy charger'), [])
+
+    def test_name_matches_rank_above_brand_matches(self):
+        self.assertEqual(self.search('galaxy'), [self.phone.id, self.case.id])
+
+    def test_category_brand_and_slug_are_searched(self):
+        self.assertEqual(self.search('samsung'), [self.phone.id])
+        self.assertEqual(set(self.search('accessories')), {self.case.id, self.charger.id})
+        self.assertEqual(self.search('usb'), [self.charger.id])
+
+    def test_index_follows_product_and_brand_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.phone.name = 'Pixel 8'
+            self.phone.slug = 'pixel-8'
+            self.phone.save()
+            self.samsung.name = 'Google'
+            self.samsung.save()
+        self.assertEqual(self.search('galaxy'), [self.case.id])
+        self.assertEqual(self.search('pixel google'), [self.phone.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.case.delete()
+        self.assertEqual(self.search('galaxy'), [])
+
+    def test_filter_products_matches_without_ranking(self):
+        self.assertEqual(set(search.filter_products(Product.objects.all(), 'gal').values_list('id', flat=True)),
+                         {self.phone.id, self.case.id})
+
+
+class KeysetPaginatorTest(TestCase):
+    def setUp(self):
+        # Prices repeat so pages split rows that tie on the sort column
+        self.products = [create_product('product-{}'.format(index), price=100 + index // 3 * 10) for index in range(10)]
+
+    def ids(self, page):
+        return [product.id for product in page]
+
+    def walk(self, paginator):
+        pages = [paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(pages[-1].next_cursor))
+        return pages
+
+    def test_pages_forward_and_backward_by_id(self):
+        paginator = KeysetPaginator(Product.objects.all(), 4, '-id')
+        pages = self.walk(paginator)
+        expected = sorted((product.id for product in self.products), reverse=True)
+        self.assertEqual([self.ids(page) for page in pages], [expected[:4], expected[4:8], expected[8:]])
+        self.assertFalse(pages[0].has_previous())
+        self.assertIsNone(pages[0].previous_cursor)
+        self.assertIsNone(pages[-1].next_cursor)
+
+        previous = paginator.get_page(pages[2].previous_cursor)
+        self.assertEqual(self.ids(previous), expected[4:8])
+        self.assertTrue(previous.has_next())
+        first = paginator.get_page(previous.previous_cursor)
+        self.assertEqual(self.ids(first), expected[:4])
+        self.assertFalse(first.has_previous())
+
+    def test_ties_on_the_sort_column_are_split_by_id(self):
+        paginator = KeysetPaginator(Product.objects.all(), 4, 'price')
+        pages = self.walk(paginator)
+        expected = [product.id for product in sorted(self.products, key=lambda product: (product.price, product.id))]
+        self.assertEqual(sum((self.ids(page) for page in pages), []), expected)
+        self.assertEqual(self.ids(paginator.get_page(pages[1].previous_cursor)), expected[:4])
+
+    def test_tampered_cursor_starts_over(self):
+        paginator = KeysetPaginator(Product.objects.all(), 4, '-id')
+        cursor = paginator.get_page().next_cursor
+        for tampered in (cursor[:-2] + 'xx', 'garbage', cursor + 'a'):
+            page = paginator.get_page(tampered)
+            self.assertEqual(self.ids(page), self.ids(paginator.get_page()))
+            self.assertFalse(page.has_previous())
+
+    def test_count_is_optional(self):
+        self.assertEqual(KeysetPaginator(Product.objects.all(), 4).count, 10)
+        paginator = KeysetPaginator(Product.objects.all(), 4, with_count=False)
+        with self.assertNumQueries(1):
+            paginator.get_page()
+            self.assertIsNone(paginator.count)
+
+
+class FacetsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.acme = Brand.objects.create(slug='acme', name='Acme')
+        self.zeta = Brand.objects.create(slug='zeta', name='Zeta')
+        self.phones = Category.objects.create(slug='phones', name='Phones')
+        self.tablets = Category.objects.create(slug='tablets', name='Tablets')
+        for index, price in enumerate([50, 100, 100, 230, 480, 500, 990, 1000, 1500, 2600]):
+            create_product('product-{}'.format(index), price=price, brand=self.acme if index % 2 else self.zeta,
+                           category=self.phones if index < 6 else self.tablets)
+
+    def products(self, **filters):
+        return Product.objects.filter(facets.filter_q(facets.normalize_filters(**filters)))
+
+    def test_round_price(self):
+        self.assertEqual([facets.round_price(value) for value in (0, 7, 137, 1234, 2650)], [0, 7, 140, 1200, 2600])
+
+    def test_price_buckets_partition_the_catalog(self):
+        buckets = facets.build_price_buckets()
+        self.assertEqual([bucket['key'] for bucket in buckets],
+                         ['under_100', '100-480', '480-990', '990-1500', 'from_1500'])
+        counts = [self.products(price=bucket['key']).count() for bucket in buckets]
+        self.assertEqual(counts, [1, 3, 2, 2, 2])
+        self.assertEqual(sum(counts), Product.objects.count())
+
+    def test_legacy_price_keys_include_both_bounds(self):
+        self.assertEqual(self.products(price='less_100').count(), 3)
+        self.assertEqual(self.products(price='100_500').count(), 5)
+        self.assertEqual(self.products(price='500_1000').count(), 3)
+        self.assertEqual(self.products(price='greater_2000').count(), 1)
+        # A generated bucket with the same bounds leaves the upper bound out
+        self.assertEqual(self.products(price='100-500').count(), 4)
+        self.assertEqual(self.products(price='bogus').count(), Product.objects.count())
+
+    def test_each_facet_ignores_its_own_filter(self):
+        result = facets.get_facets(facets.normalize_filters(brand=self.acme.id, category=self.phones.id))
+        brands = {brand['id']: brand['product_count'] for brand in result['brands']}
+        categories = {category['id']: category['product_count'] for category in result['categories']}
+        # Brands within phones, categories within Acme
+        self.assertEqual(brands, {self.acme.id: 3, self.zeta.id: 3})
+        self.assertEqual(categories, {self.phones.id: 3, self.tablets.id: 2})
+        self.assertEqual(sum(price['product_count'] for price in result['prices']), 3)
+
+    def test_facets_are_cached_per_filter_set(self):
+        filters = facets.normalize_filters(brand=self.zeta.id)
+        facets.get_facets(filters)
+        with self.assertNumQueries(0):
+            facets.get_facets(facets.normalize_filters(brand=str(self.zeta.id)))
+
+
+class ViewCounterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.viewed = create_product('acme-phone')
+        self.other = create_product('acme-tablet')
+
+    def view_count(self, product):
+        return Product.objects.get(id=product.id).view_count
+
+    def test_views_are_counted_without_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual([counters.record_view(self.viewed.id) for _ in range(3)], [1, 2, 3])
+        self.assertEqual(self.view_count(self.viewed), 0)
+
+    def test_flush_writes_only_the_queued_products(self):
+        for _ in range(3):
+            counters.record_view(self.viewed.id)
+        with mock.patch('main.counters.get_pending_views', wraps=counters.get_pending_views) as get_pending_views:
+            self.assertEqual(counters.flush_views(), (1, 3))
+        self.assertEqual(set(get_pending_views.call_args[0][0]), {self.viewed.id})
+        self.assertEqual(self.view_count(self.viewed), 3)
+        self.assertEqual(self.view_count(self.other), 0)
+        # Nothing is queued until the next view
+        self.assertEqual(counters.flush_views(), (0, 0))
+        counters.record_view(self.viewed.id)
+        self.assertEqual(counters.flush_views(), (1, 1))
+        self.assertEqual(self.view_count(self.viewed), 4)
+
+    def test_views_recorded_during_a_flush_are_queued_again(self):
+        counters.record_view(self.viewed.id)
+        get_pending_views = counters.get_pending_views
+
+        def pending_views(product_ids):
+            pending = get_pending_views(product_ids)
+            # Counted after the flush read the buffer, the count is above zero so the view does not queue the product
+            self.assertEqual(counters.record_view(self.viewed.id), 2)
+            return pending
+
+        with mock.patch('main.counters.get_pending_views', side_effect=pending_views):
+            self.assertEqual(counters.flush_views(), (1, 1))
+        self.assertEqual(counters.flush_views(), (1, 1))
+        self.assertEqual(self.view_count(self.viewed), 2)
+
+    def test_a_running_flush_is_not_repeated(self):
+        counters.record_view(self.viewed.id)
+        cache.add(counters.FLUSH_LOCK_KEY, 1)
+        self.assertEqual(counters.flush_views(), (0, 0))
+        cache.delete(counters.FLUSH_LOCK_KEY)
+        self.assertEqual(counters.flush_views(), (1, 1))
+
+    def test_all_products_picks_up_views_whose_slot_was_lost(self):
+        counters.record_view(self.viewed.id)
+        cache.delete(counters.DIRTY_SLOT_KEY.format(slot=1))
+        self.assertEqual(counters.flush_views(), (0, 0))
+        stdout = StringIO()
+        call_command('flush_view_counts', '--all', stdout=stdout)
+        self.assertIn('Flushed 1 views for 1 products', stdout.getvalue())
+        self.assertEqual(self.view_count(self.viewed), 1)
+
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.rendered = []
+        self.view = page_cache.cache_anonymous_page(lambda request: [page_cache.LISTING_TAG])(self.render)
+
+    def render(self, request):
+        self.rendered.append(request)
+        return HttpResponse('<input type="hidden" name="csrfmiddlewaretoken" value="{}">'.format(get_token(request)))
+
+    def request(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        request._messages = CookieStorage(request)
+        return request
+
+    def test_each_hit_gets_its_own_csrf_token(self):
+        first = self.view(self.request())
+        request = self.request()
+        second = self.view(request)
+        self.assertEqual(len(self.rendered), 1)
+        self.assertNotIn(page_cache.CSRF_PLACEHOLDER, second.content)
+        self.assertNotEqual(first.content, second.content)
+        # The hit generated a token, so the CSRF middleware sends this visitor its cookie
+        self.assertIn('CSRF_COOKIE', request.META)
+
+    def test_pending_messages_bypass_the_cache(self):
+        request = self.request()
+        messages.success(request, 'Added to cart')
+        self.view(request)
+        self.view(self.request())
+        self.assertEqual(len(self.rendered), 2)
+
+    def test_pages_adding_messages_or_cookies_are_not_stored(self):
+        def render(request):
+            response = self.render(request)
+            if len(self.rendered) == 1:
+                messages.info(request, 'Welcome back')
+            else:
+                response.set_cookie('recently_viewed', '1')
+            return response
+
+        view = page_cache.cache_anonymous_page(lambda request: [page_cache.LISTING_TAG])(render)
+        for _ in range(3):
+            view(self.request())
+        self.assertEqual(len(self.rendered), 3)
+
+    def test_bumped_tag_drops_the_page(self):
+        self.view(self.request())
+        page_cache.bump_tags(page_cache.LISTING_TAG)
+        self.view(self.request())
+        self.assertEqual(len(self.rendered), 2)
+
+    def test_renamed_product_invalidates_the_old_and_new_slug(self):
+        product = create_product('acme-phone')
+        tags = [page_cache.product_tag('acme-phone'), page_cache.product_tag('acme-phone-2')]
+        versions = get_versions(page_cache.tag_keys(tags))
+        product.slug = 'acme-phone-2'
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        for old, new in zip(versions, get_versions(page_cache.tag_keys(tags))):
+            self.assertNotEqual(old, new)
+
+
+class LeaderboardTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = []
+        for index in range(leaderboards.LEADERBOARD_DEPTH + 5):
+            product = create_product('product-{}'.format(index))
+            Product.objects.filter(id=product.id).update(sold=index * 10)
+            self.products.append(Product.objects.get(id=product.id))
+
+    def sold(self, board):
+        return [product.sold for product in board['products']]
+
+    def with_sold(self, index, sold):
+        product = self.products[index]
+        product.sold = sold
+        return product
+
+    def test_board_is_cut_at_its_depth_with_a_floor(self):
+        board = leaderboards.build_leaderboard('sold')
+        self.assertEqual(self.sold(board), list(range(240, 40, -10)))
+        self.assertEqual(board['floor'], (50, self.products[5].id))
+
+    def test_product_rising_above_the_floor_enters_the_board(self):
+        board = leaderboards.merge_leaderboard(leaderboards.build_leaderboard('sold'), [self.with_sold(2, 500)], 'sold')
+        self.assertEqual(board['products'][0].id, self.products[2].id)
+        self.assertEqual(len(board['products']), leaderboards.LEADERBOARD_DEPTH)
+        # The last entry was pushed out, the floor moves up to the new last entry
+        self.assertEqual(board['floor'], (60, self.products[6].id))
+
+    def test_product_falling_below_the_floor_leaves_the_board(self):
+        board = leaderboards.merge_leaderboard(leaderboards.build_leaderboard('sold'), [self.with_sold(10, 0)], 'sold')
+        self.assertNotIn(self.products[10].id, [product.id for product in board['products']])
+        self.assertEqual(board['floor'], (50, self.products[5].id))
+        # Products the board never loaded may outrank it, the board no longer knows enough and is rebuilt
+        fallen = [self.with_sold(index, 0) for index in range(5, 16)]
+        self.assertIsNone(leaderboards.merge_leaderboard(board, fallen, 'sold'))
+
+    def test_board_without_a_floor_takes_every_change(self):
+        board = {'products': self.products[:3], 'floor': None}
+        board = leaderboards.merge_leaderboard(board, [self.with_sold(0, 15), self.with_sold(24, 5)], 'sold')
+        self.assertEqual(self.sold(board), [20, 15, 10, 5])
+
+    def test_counter_saves_update_the_cached_board(self):
+        leaderboards.get_leaderboard('sold')
+        product = self.with_sold(0, 1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save(update_fields=['sold'])
+        with self.assertNumQueries(0):
+            self.assertEqual(leaderboards.get_leaderboard('sold', size=1), [product])
+
+    def test_other_saves_rebuild_the_board(self):
+        leaderboards.get_leaderboard('sold')
+        product = self.products[0]
+        product.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        with self.assertNumQueries(1):
+            leaderboards.get_leaderboard('sold')
+
+
+class AutocompleteTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        for slug, name, sold in (('galaxy-s23', 'Samsung Galaxy S23', 50), ('galaxy-tab', 'Samsung Galaxy Tab', 80),
+                                 ('pixel-8', 'Pixel 8', 10)):
+            product = create_product(slug, name=name)
+            Product.objects.filter(id=product.id).update(sold=sold)
+        self.index = autocomplete.rebuild_index()
+
+    def names(self, query, **kwargs):
+        return [entry['name'] for entry in autocomplete.suggest(query, **kwargs)]
+
+    def test_words_and_whole_names_match_by_prefix(self):
+        self.assertEqual(self.names('gal'), ['Samsung Galaxy Tab', 'Samsung Galaxy S23'])
+        self.assertEqual(self.names('samsung galaxy s'), ['Samsung Galaxy S23'])
+        self.assertEqual(self.names('TAB sam'), ['Samsung Galaxy Tab'])
+        self.assertEqual(self.names('pixel-8'), ['Pixel 8'])
+        self.assertEqual(self.names('iphone'), [])
+        self.assertEqual(self.names('  '), [])
+
+    def test_brands_and_categories_rank_by_their_sales(self):
+        self.assertEqual(autocomplete.suggest('acme'), [{'type': 'brand', 'name': 'Acme',
+                                                         'url': '/customer/product/brand/acme/'}])
+        self.assertEqual(self.names('p', limit=2), ['Phones', 'Pixel 8'])
+
+    def test_lookups_read_the_index_without_queries(self):
+        with self.assertNumQueries(0):
+            self.names('galaxy')
+
+    def test_rebuild_swaps_in_a_new_index(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_product('galaxy-watch', name='Samsung Galaxy Watch')
+        index = autocomplete.get_index()
+        self.assertIsNot(index, self.index)
+        self.assertEqual(len(autocomplete.lookup('watch', index)), 1)
+        # A lookup still holding the previous index sees it whole and unchanged
+        self.assertFalse(autocomplete.lookup('watch', self.index))
+        self.assertEqual(len(self.index.terms), len(self.index.entries))
+        self.assertIs(autocomplete.get_index(), index)
+
+
+class BadgesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = create_customer('shopper')
+        self.user_id = self.customer.user_id
+        self.products = [create_product('acme-phone-{}'.format(index)) for index in range(3)]
+
+    def test_counts_are_loaded_once(self):
+        cart.add_item(self.customer, self.products[0].slug)
+        with self.assertNumQueries(2):
+            self.assertEqual(badges.get_badges(self.user_id), {badges.CART: 1, badges.WISHLIST: 0})
+        with self.assertNumQueries(0):
+            self.assertEqual(badges.get_badges(self.user_id), {badges.CART: 1, badges.WISHLIST: 0})
+
+    def test_cart_changes_move_the_cached_count(self):
+        badges.get_badges(self.user_id)
+        for product in self.products:
+            cart.add_item(self.customer, product.slug)
+        # More units of a line already in the cart do not change the line count
+        cart.add_item(self.customer, self.products[0].slug)
+        cart.remove_item(self.customer, self.products[1].slug)
+        cart.change_quantity(self.customer, self.products[2].slug, -1)
+        with self.assertNumQueries(0):
+            self.assertEqual(badges.get_badges(self.user_id)[badges.CART], 1)
+
+    def test_counts_not_cached_are_left_to_the_next_read(self):
+        badges.adjust_badge(self.user_id, badges.CART, 1)
+        self.assertIsNone(cache.get(badges.badge_key(self.user_id, badges.CART)))
+        badges.set_badge(self.user_id, badges.CART, 0)
+        badges.adjust_badge(self.user_id, badges.CART, -1)
+        # A count that drifted below zero is dropped and counted again
+        self.assertIsNone(cache.get(badges.badge_key(self.user_id, badges.CART)))
+        cart.add_item(self.customer, self.products[0].slug)
+        self.assertEqual(badges.get_badges(self.user_id)[badges.CART], 1)
+
+    def test_forgotten_counts_are_recounted(self):
+        badges.set_badge(self.user_id, badges.CART, 5)
+        badges.set_badge(self.user_id, badges.WISHLIST, 5)
+        badges.forget_badges(self.user_id)
+        self.assertEqual(badges.get_badges(self.user_id), {badges.CART: 0, badges.WISHLIST: 0})
+
+    def test_header_shows_the_cached_counts(self):
+        badges.set_badge(self.user_id, badges.CART, 2)
+        badges.set_badge(self.user_id, badges.WISHLIST, 4)
+        self.client.force_login(self.customer.user)
+        response = self.client.get('/')
+        self.assertContains(response, 'Cart(<span class="cart-badge">2</span>)')
+        self.assertContains(response, 'WishList(4)')
@@ -0,0 +1,52 @@
+import os
+import socket
+import threading
+import time
+import zlib
+
+# Snowflake style payment transaction ids: 41 bits of milliseconds since EPOCH_MS, 10 bits of worker id and 12
+# bits of sequence within the millisecond. Ids from one process are strictly increasing, ids from different
+# workers differ by the worker bits. Worker ids are not allocated, a derived one can collide with another
+# process's and a configured one is shared by the processes forked on the node, so two processes may produce
+# the same id: checkout.create_payment retries an id the unique index rejects. They are stored as fixed width
+# decimal strings so text order is time order.
+EPOCH_MS = 1672531200000  # 2023-01-01 UTC
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+ID_DIGITS = 19
+
+_lock = threading.Lock()
+_state = {'pid': None, 'worker': 0, 'last_ms': 0, 'sequence': 0}
+
+
+# TRANSACTION_ID_WORKER pins the worker id per node, otherwise it is derived from the host name and process id
+def worker_id():
+    configured = os.environ.get('TRANSACTION_ID_WORKER')
+    if configured is not None:
+        return int(configured) & MAX_WORKER
+    return zlib.crc32('{}:{}'.format(socket.gethostname(), os.getpid()).encode()) & MAX_WORKER
+
+
+def now_ms():
+    return int(time.time() * 1000) - EPOCH_MS
+
+
+def new_transaction_id():
+    with _lock:
+        # Forked workers (gunicorn) get their own worker id and sequence
+        if _state['pid'] != os.getpid():
+            _state.update(pid=os.getpid(), worker=worker_id(), last_ms=0, sequence=0)
+        # Never go back in time, even when the clock does
+        ms = max(now_ms(), _state['last_ms'])
+        if ms == _state['last_ms']:
+            _state['sequence'] = (_state['sequence'] + 1) & MAX_SEQUENCE
+            if _state['sequence'] == 0:
+                # Sequence exhausted for this millisecond, borrow the next one
+                ms += 1
+        else:
+            _state['sequence'] = 0
+        _state['last_ms'] = ms
+        value = (ms << (WORKER_BITS + SEQUENCE_BITS)) | (_state['worker'] << SEQUENCE_BITS) | _state['sequence']
+    return str(value).zfill(ID_DIGITS)
@@ -2,6 +2,10 @@ from django.contrib.auth import authenticate, login as auth_login, update_sessio
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator
+from .pagination import KeysetPaginator
+from .page_cache import cache_anonymous_page, LISTING_TAG, NAVIGATION_TAG
+from .leaderboards import get_leaderboard
+from . import outbox
 from django.db.models import Count, Avg
 
 # from django.http import HttpResponse, HttpResponseRedirect
@@ -10,8 +14,7 @@ from .forms import RegisterForm, LoginForm, UpdateProfileForm, ChangePasswordFor
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required, user_passes_test
 # Password Reset Imports
-from django.core.mail import send_mail, BadHeaderError, EmailMessage
-from django.http import HttpResponse
+from django.core.mail import EmailMessage
 from django.contrib.auth.forms import PasswordResetForm
 from django.template.loader import render_to_string
 from django.db.models.query_utils import Q
@@ -21,14 +24,18 @@ from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes, force_str
 from .tokens import account_activation_token, password_reset_token, update_email_token
 from django.contrib.auth.models import User
-from .models import Customer, Product, Category, Brand, DeliveryAddress, Review
+from .models import Customer, Product, DeliveryAddress, Review
 
 
 # Create your views here.
-def paginator(request, objects):
+def paginator(request, objects, ordering=None, with_count=True):
     # Set the number of items per page
     per_page = 8
 
+    # Keyset mode: seek on (ordering, id) from the opaque cursor in the request's GET parameters
+    if ordering:
+        return KeysetPaginator(objects, per_page, ordering, with_count).get_page(request.GET.get('cursor'))
+
     # Create a Paginator object with the customers queryset and the per_page value
     page = Paginator(objects, per_page)
 
@@ -41,17 +48,15 @@ def paginator(request, objects):
 
 
 # Display Homepage for all users. Display List of all products, categories, brands, etc.
+@cache_anonymous_page(lambda request: [LISTING_TAG, NAVIGATION_TAG])
 def home(request):
+    # Categories and brands come from the cached navigation context processors
     products = Product.objects.all().order_by('-sold')
-    categories = Category.objects.all().order_by('id')
-    brands = Brand.objects.all().order_by('id')
     page_object = paginator(request, products)
-    best_selling_products = Product.objects.all().order_by('-sold')[:4]
-    recommended_products = Product.objects.all().order_by('-view_count')[:4]
+    best_selling_products = get_leaderboard('sold')
+    recommended_products = get_leaderboard('view_count')
 
     context = {'products': page_object,
-               'categories': categories,
-               'brands': brands,
                'best_selling_products': best_selling_products,
                'recommended_products': recommended_products
                }
@@ -120,7 +125,7 @@ def send_email_activate_account(request, user):
     form_email = 'LCL Shop <lclshop.dev@gmail.com>'
     email = EmailMessage(mail_subject, message, form_email, to_email)
     email.content_subtype = "html"
-    email.send()
+    outbox.queue(email)
 
 
 def activate(request, uidb64, token):
@@ -191,7 +196,7 @@ def send_verify_new_email(request, user):
     form_email = 'LCL Shop <lclshop.dev@gmail.com>'
     email = EmailMessage(mail_subject, message, form_email, to_email)
     email.content_subtype = "html"
-    email.send()
+    outbox.queue(email)
 
 
 def activate_new_email(request, uidb64, token):
@@ -321,10 +326,9 @@ def password_reset_request(request):
                     email = render_to_string(email_template_name, c)
                     form_email = 'LCL Shop <lclshop.dev@gmail.com>'
                     # sender_email = settings.EMAIL_HOST_USER
-                    try:
-                        send_mail(subject, email, form_email, [user.email], fail_silently=False, html_message=email)
-                    except BadHeaderError:
-                        return HttpResponse('Invalid header found.')
+                    email = EmailMessage(subject, email, form_email, [user.email])
+                    email.content_subtype = "html"
+                    outbox.queue(email)
 
                 return redirect("/auth/password_reset/done/")
             else: